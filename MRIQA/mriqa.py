@@ -22,6 +22,24 @@ def command_line_parser(opts):
     parser.add_argument("module", type=str, help="Select MRI QA module: rename, uniformity, all")
     return parser.parse_known_args(opts), parser
 
+def module_args(parse, args):
+    """Return the command line arguments accepted by an MRI QA module, and those it does not recognise.
+    Args:
+        parse - The module's command line parser function, called with known=True.
+        args - A list containing the command line arguments for all modules.
+    Returns:
+        A tuple (module_args, unrecognised), each a list of command line arguments.
+    """
+    unrecognised = parse(args, known=True)[1]
+    # Remove the unrecognised arguments, in order
+    accepted, i = [], 0
+    for arg in args:
+        if i < len(unrecognised) and arg == unrecognised[i]:
+            i += 1
+        else:
+            accepted.append(arg)
+    return accepted, unrecognised
+
 def main(args):
     """
     Call the relevant MRI QA module with the given command line arguments.
@@ -33,12 +51,19 @@ def main(args):
 
     # Create a dictionary mapping the MRI QA module name with its .main function
     MODULES = collections.OrderedDict({"rename":rename.main, "uniformity": uniformity.main})
+    # Command line parsers of each module, used to pass each module only its own options when running 'all'
+    PARSERS = {"rename": rename.command_line_parser, "uniformity": uniformity.cli}
 
     # If command line module given is 'all'
     if opts.module == "all":
+        # Split the options between modules, and exit if an option is not recognised by any module
+        split = {module: module_args(PARSERS[module], args) for module in MODULES}
+        unrecognised = set.intersection(*[set(extra) for accepted, extra in split.values()])
+        if unrecognised:
+            parser.error('unrecognized arguments: {}'.format(' '.join(arg for arg in args if arg in unrecognised)))
         # Run all MRI QA modules in the order displayed in MODULES. (Rename must come first).
         for module, module_main in MODULES.items():
-            module_main(args)
+            module_main(split[module][0])
     # Else if the module given is in MODULES and run as standalone
     elif opts.module in MODULES.keys():
         MODULES[opts.module](args)
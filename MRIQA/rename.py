@@ -9,20 +9,39 @@ Created: 30th April 2018
 """
 
 import argparse
+import concurrent.futures
 import configparser
-import itertools
 import logging
 import os
+import queue
 import re
 import shutil
+import sqlite3
 import sys
+import threading
 import pydicom
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
+# DICOM tags read from each file. Renaming only needs the header, so pixel data is never loaded.
+HEADER_TAGS = ['SeriesDescription', 'SOPInstanceUID']
+# Record of processed files, kept in the input directory for incremental runs
+MANIFEST = '.rename_manifest.sqlite'
+# Ways of linking output files to their input file instead of copying
+LINKS = ('hard', 'sym', 'reflink')
+# Names of each link type for log messages
+LINK_NAMES = {'hard': 'hard link', 'sym': 'symbolic link', 'reflink': 'reflink'}
+# Linux ioctl request to share the data blocks of a file (on filesystems such as Btrfs and XFS)
+FICLONE = 0x40049409
 
-def command_line_parser(args):
+
+def command_line_parser(args, known=False):
     """Parse command line arguments,
     Args:
         args - A list containing the command line string split by spaces.
+        known - If True, also return the arguments not recognised, as argparse parse_known_args().
     Returns:
         An argparse.ArgumentParser object containing attributes for the input directory and config.
     """
@@ -30,19 +49,32 @@ def command_line_parser(args):
         'medical physics SOP MPB138 (QA ImageHandling)')
     parser.add_argument('-i', type=str, metavar='indir', help='Directory containing DICOM files', required=True)
     parser.add_argument('-c', type=str, metavar='config', help='config file containing filename regular expressions', required=True)
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='jobs',
+        help='number of processes reading DICOM headers and threads copying files (default: 1)')
+    parser.add_argument('--link', choices=LINKS,
+        help='link renamed and unnamed files to the input files instead of copying (copies if a link cannot be made)')
+    parser.add_argument('--incremental', action='store_true',
+        help='rename only files that are new or changed since the last run, keeping existing outputs')
     parser.add_argument('-v', action='version', version='{} v1.0'.format(parser.prog))
-    return parser.parse_args(args)
+    return parser.parse_known_args(args) if known else parser.parse_args(args)
 
 def manage_dirs(opts):
-    """Create the output directories if they do not exist, else exit if it they do.
+    """Create the output directories if they do not exist, else exit if it they do (unless running
+    incrementally, when existing directories are used).
     Args:
-        opts - An argparse.ArgumentParser object with an attribute for the input directory (opts.i).
+        opts - An argparse.ArgumentParser object with an attribute for the input directory (opts.i),
+            and opts.incremental.
     Returns:
         A tuple with the full paths of the new directories in the format (renamed_directory, unnamed_directory)
     """
     # Set the directory for renamed and unnamed dicom files respectively
     renamed_dir = os.path.join(opts.i, 'renamed')
     unnamed_dir = os.path.join(opts.i, 'unnamed')
+    # Use existing directories for incremental runs
+    if getattr(opts, 'incremental', False):
+        os.makedirs(renamed_dir, exist_ok=True)
+        os.makedirs(unnamed_dir, exist_ok=True)
+        return(renamed_dir, unnamed_dir)
     # Create directories and return
     try:
         os.mkdir(renamed_dir)
@@ -54,6 +86,248 @@ def manage_dirs(opts):
         exit()
 
 
+def is_dicom(infile):
+    """Return True if the file has the DICOM file preamble ('DICM' at byte 128). Checked before
+    parsing so that non-DICOM files are rejected by reading 132 bytes.
+    Args:
+        infile - A file to be checked
+    """
+    try:
+        with open(infile, 'rb') as f:
+            f.seek(128)
+            return f.read(4) == b'DICM'
+    except OSError:
+        return False
+
+def read_header(infile):
+    """Read the DICOM header tags used for renaming (HEADER_TAGS), stopping before pixel data.
+    Args:
+        infile - A DICOM file
+    Returns:
+        A pydicom.dataset.FileDataset containing HEADER_TAGS (where present) and no pixel data.
+    """
+    return pydicom.dcmread(infile, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+
+def link_file(infile, dest, link):
+    """Create dest as a hard link, symbolic link or reflink (copy-on-write clone) of infile,
+    replacing any existing file. Raises OSError if the link cannot be made, for example if infile and
+    dest are on different filesystems or the filesystem does not support the link type.
+    Args:
+        infile - A file to be linked
+        dest - Output file path
+        link - Link type, one of LINKS
+    """
+    # Remove any existing file first. Writing to an earlier link would overwrite its input file.
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if link == 'reflink':
+        if fcntl is None:
+            raise OSError('reflinks are not supported on this platform')
+        with open(infile, 'rb') as src, open(dest, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copymode(infile, dest)
+    elif link == 'hard':
+        os.link(infile, dest)
+    else:
+        os.symlink(os.path.abspath(infile), dest)
+
+def read_description(infile):
+    """Read the Series Description used to rename a file. Called in worker processes when RenameQA
+    is run with more than one job.
+    Args:
+        infile - A file to be processed for renaming
+    Returns:
+        A tuple (is_dicom, desc, uid). is_dicom is False if the file is not DICOM format. desc is the
+        lower case SeriesDescription, or None if the file does not contain one. uid is the
+        SOPInstanceUID, or None.
+    """
+    # Return if the file does not have a DICOM preamble
+    if not is_dicom(infile):
+        return False, None, None
+    # Attempt to read the DICOM header
+    try:
+        dcm = read_header(infile)
+    except(pydicom.errors.InvalidDicomError):
+        return False, None, None
+    uid = str(dcm.SOPInstanceUID) if 'SOPInstanceUID' in dcm else None
+    # Attempt to store the series description
+    try:
+        return True, dcm.SeriesDescription.lower(), uid
+    except AttributeError:
+        return True, None, uid
+
+
+class Classifier(object):
+    """Classify Series Descriptions by the regular expressions in the [regex] section of the config
+    file. The expressions are combined into a single compiled pattern, with a named group for each
+    config category, and the result for each distinct description is cached.
+
+    Attributes:
+        pattern: Compiled pattern, or None if the config file has no regular expressions.
+        cache: Dict mapping Series Descriptions to categories.
+    """
+
+    def __init__(self, config):
+        # Combine the expressions for each category, slice position files first so that they are
+        # always prefixed. Empty expressions (e.g. from ',,') would match every file and are ignored.
+        categories = sorted(config['regex'], key=lambda category: category != 'sli_pos')
+        groups = []
+        for category in categories:
+            regexes = [regex.strip().strip("'") for regex in config['regex'][category].split(',')]
+            regexes = ['(?:{})'.format(regex) for regex in regexes if regex]
+            if regexes:
+                groups.append('(?P<{}>{})'.format(category, '|'.join(regexes)))
+        self.pattern = re.compile('|'.join(groups), flags=re.IGNORECASE) if groups else None
+        self.cache = {}
+
+    def classify(self, desc):
+        """Return the config category (e.g. 'HEAD_COIL') whose regular expression matches the start of
+        the Series Description desc, or None if there is no match."""
+        try:
+            return self.cache[desc]
+        except KeyError:
+            match = self.pattern.match(desc) if self.pattern else None
+            category = self.cache[desc] = match.lastgroup.upper() if match else None
+            return category
+
+
+class Manifest(object):
+    """SQLite record of the files processed by RenameQA, with the size and modification time of each
+    file when processed, its SOPInstanceUID, how it was handled and the output file written.
+
+    Attributes:
+        path: SQLite database file.
+        db: sqlite3.Connection to the database. Changes are committed by close().
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            uid TEXT,
+            status TEXT,
+            output TEXT
+        );
+        CREATE INDEX IF NOT EXISTS files_uid ON files (uid);
+    """
+
+    def __init__(self, path, reset=False):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.SCHEMA)
+        # Forget files processed by earlier runs
+        if reset:
+            self.db.execute('DELETE FROM files')
+
+    def unchanged(self, infile, stat):
+        """Return True if infile has been processed with the same size and modification time (an
+        os.stat_result) and its output file, if any, still exists."""
+        row = self.db.execute('SELECT size, mtime, output FROM files WHERE path = ?', (infile,)).fetchone()
+        if row is None:
+            return False
+        size, mtime, output = row
+        return (size, mtime) == (stat.st_size, stat.st_mtime) and (output is None or os.path.lexists(output))
+
+    def renamed_uid(self, uid, infile):
+        """Return the path of a file other than infile renamed with the SOPInstanceUID uid, or None."""
+        row = self.db.execute("SELECT path FROM files WHERE uid = ? AND path != ? AND status = 'renamed'",
+            (uid, infile)).fetchone()
+        return row[0] if row else None
+
+    def outputs(self):
+        """Return a dict mapping each recorded output file to the input file copied to it."""
+        return dict(self.db.execute('SELECT output, path FROM files WHERE output IS NOT NULL'))
+
+    def add(self, infile, stat, uid, status, output=None):
+        """Record a processed file.
+        Args:
+            infile - Input file path
+            stat - os.stat_result of the input file before it was processed
+            uid - SOPInstanceUID, or None
+            status - 'renamed', 'unnamed', 'duplicate' or 'not_dicom'
+            output - Output file path, or None
+        """
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+            (infile, stat.st_size, stat.st_mtime, uid, status, output))
+
+    def remove(self, infile):
+        """Forget a file, so that it is processed again by the next run."""
+        self.db.execute('DELETE FROM files WHERE path = ?', (infile,))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class Copier(object):
+    """Copy files in background threads, so that copying overlaps with reading DICOM headers. Each
+    thread takes copies from a bounded queue, holding up the caller when copying falls behind. Copies
+    to the same destination are always queued to the same thread, so they are made in the order
+    queued and the last file queued is the one kept.
+
+    Attributes:
+        threads: Number of copy threads. If 0, files are copied immediately in the calling thread.
+        link: If set, link files (see LINKS) instead of copying them. Files are copied where the
+            link cannot be made.
+        failures: List of (infile, dest, error) tuples for files that could not be copied.
+    """
+    # Maximum number of copies waiting in each thread's queue
+    QUEUE_SIZE = 64
+
+    def __init__(self, threads=0, link=None):
+        self.logger = logging.getLogger('mriqa.rename.Copier')
+        self.link = link
+        self.link_failed = False
+        self.failures = []
+        self.queues = [queue.Queue(self.QUEUE_SIZE) for i in range(threads)]
+        self.started = False
+
+    def copy(self, infile, dest):
+        """Copy infile to the file path dest."""
+        if not self.queues:
+            self.run(infile, dest)
+            return
+        # Start threads on first use, after any worker processes have been forked
+        if not self.started:
+            for jobs in self.queues:
+                threading.Thread(target=self.worker, args=(jobs,), daemon=True).start()
+            self.started = True
+        self.queues[hash(dest) % len(self.queues)].put((infile, dest))
+
+    def run(self, infile, dest):
+        try:
+            # Replace existing outputs rather than writing to them, as they may be links to input files
+            # made by an earlier run
+            if os.path.lexists(dest):
+                os.remove(dest)
+            if self.link:
+                try:
+                    link_file(infile, dest, self.link)
+                    return
+                # Fall back to copying, warning once per run. Remove any partly made link first.
+                except OSError as error:
+                    if not self.link_failed:
+                        self.link_failed = True
+                        self.logger.warning('Cannot create {}s ({}), copying files instead'.format(
+                            LINK_NAMES[self.link], error))
+                    if os.path.lexists(dest):
+                        os.remove(dest)
+            shutil.copy(infile, dest)
+        except OSError as error:
+            self.failures.append((infile, dest, error))
+
+    def worker(self, jobs):
+        while True:
+            infile, dest = jobs.get()
+            self.run(infile, dest)
+            jobs.task_done()
+
+    def flush(self):
+        """Wait for all queued copies to be made."""
+        for jobs in self.queues:
+            jobs.join()
+
+
 class RenameQA(object):
     """Rename MRI QA files as outlined in SOP MPB138.
     Ars:
@@ -61,9 +335,17 @@ class RenameQA(object):
         outdir - Output directory
         unnmrdir - Directory for unnamed files
         config - A configparser.ConfigParser() object that has read the config.ini input file
+        jobs - Number of worker processes reading DICOM headers, and threads copying files. If 1, each
+            file is read and copied in turn.
+        link - If set, link output files to the input files (hard, sym or reflink) instead of copying.
+        incremental - If True, only process files that are new or changed since the last run (as
+            recorded in the MANIFEST file in indir), and skip files with the SOPInstanceUID of a file
+            already renamed. Otherwise the manifest is cleared and all files are processed.
     """
+    # Number of files sent to a worker process at a time
+    CHUNKSIZE = 16
 
-    def __init__(self, indir, outdir, unnmdir, config):
+    def __init__(self, indir, outdir, unnmdir, config, jobs=1, link=None, incremental=False):
         # Create class instance of the console logger
         self.logger = logging.getLogger('mriqa.rename.RenameQA')
 
@@ -73,26 +355,66 @@ class RenameQA(object):
         self.unnmdir = unnmdir
         self.config=config
 
-        # Create a combined list of all DICOM filename regular expressions from the config object
-        self.FNAMES = set(itertools.chain.from_iterable(
-                [config['regex'][row].split(',') for row in config['regex']]
-                ))
+        # Build the Series Description classifier from the config object's regular expressions
+        self.classifier = Classifier(config)
         
         # Set counters for files processed
         self.dcm_count = 0 # Dicom files found
         self.file_count = 0 # All files found
         self.dcm_rename_count = 0 # Dicom files renamed
+        self.skip_count = 0 # Files unchanged since the last run
+        # Open the record of processed files, and the input file copied to each output path (to
+        # report files renamed to the same name)
+        self.incremental = incremental
+        self.manifest = Manifest(os.path.join(self.indir, MANIFEST), reset=not incremental)
+        self.outputs = self.manifest.outputs()
+        self.stats = {}
+        self.copier = Copier(jobs if jobs > 1 else 0, link)
 
-        # Loop through all files in the input directory and call process() on the file
+        # Loop through all new or changed files in the input directory and call process() on the file
         self.logger.info('Processing DICOM files in {}'.format(self.indir))
-        for dcm_file in self.filepath(self.indir):
-            self.file_count += 1
-            self.process(dcm_file)
+        files = self.pending(self.filepath(self.indir))
+        if jobs > 1:
+            # Read headers in worker processes. Results are returned in input file order, so renaming
+            # is the same as when files are processed in turn.
+            files = list(files)
+            with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+                for dcm_file, header in zip(files, pool.map(read_description, files, chunksize=self.CHUNKSIZE)):
+                    self.process(dcm_file, header)
+        else:
+            for dcm_file in files:
+                self.process(dcm_file)
+        # Wait for copies to finish and report files that could not be copied. These are processed
+        # again by the next incremental run.
+        self.copier.flush()
+        for infile, dest, error in self.copier.failures:
+            self.logger.error('Could not copy {} to {}: {}'.format(infile, dest, error))
+            self.manifest.remove(infile)
+            if os.path.dirname(dest) == self.outdir:
+                self.dcm_rename_count -= 1
+        self.manifest.close()
         # Report number files processed
         self.logger.info('Found {} files. Renamed {}/{} DICOM files'.format(self.file_count, self.dcm_rename_count, self.dcm_count))
+        if incremental:
+            self.logger.info('Skipped {} files unchanged since the last run'.format(self.skip_count))
+
+    def pending(self, files):
+        """Count files and yield those to be processed: all files, or if running incrementally, files
+        that are new or changed since the last run.
+        Args:
+            files - Iterable of input file paths
+        """
+        for infile in files:
+            self.file_count += 1
+            stat = os.stat(infile)
+            if self.incremental and self.manifest.unchanged(infile, stat):
+                self.skip_count += 1
+                continue
+            self.stats[infile] = stat
+            yield infile
 
     def filepath(self, indir):
-        """Return the absolute path for all files in the given directory.
+        """Return the absolute path for all files in the given directory, in sorted order.
         Args:
             indir - Input directory
         """
@@ -101,56 +423,85 @@ class RenameQA(object):
 
         # Loop through directroy tree
         for path,dirs,filenames in dirtree:
-            for f in filenames:
+            # Sort so that files renamed to the same name are always processed in the same order
+            dirs.sort()
+            for f in sorted(filenames):
                     # Print file if path does not match output directory or unnamed file directory
                     # Stops the search accessing files that have already been processed
-                    if all(map(lambda dir: path != dir, [self.outdir, self.unnmdir])):
+                    if all(map(lambda dir: path != dir, [self.outdir, self.unnmdir])) and \
+                            not (path == self.indir and f.startswith(MANIFEST)):
                         yield os.path.abspath(os.path.join(path, f))
 
+    def copy(self, infile, dest):
+        """Copy a file to the output path dest, warning if an earlier file was copied to the same path.
+        Args:
+            infile - A file to be copied
+            dest - Output file path
+        """
+        if self.outputs.get(dest, infile) != infile:
+            self.logger.warning('Duplicate output {}: {} replaces {}'.format(
+                dest, os.path.basename(infile), os.path.basename(self.outputs[dest])))
+        self.outputs[dest] = infile
+        self.copier.copy(infile, dest)
+
     def copy_unnamed(self, infile):
         """Copy files to the directory set to self.unnmdir
         Args:
             infile - A file which is unable to be renamed by the script
         """
         # Copy file to the unnamed directory
-        shutil.copy(infile, self.unnmdir)
+        dest = os.path.join(self.unnmdir, os.path.basename(infile))
+        self.copy(infile, dest)
         # Write details to console log
         self.logger.warning('Unnamed (file,SeriesDescription): {}'.format(os.path.basename(infile)))        
+        return dest
 
-    def process(self, infile):
+    def process(self, infile, header=None):
         """Validate and rename DICOM files.
         Args: 
             infile - A file to be processed for renaming
+            header - The (is_dicom, desc, uid) tuple returned by read_description(infile), if already read.
         """
-        # Attempt to read the file as a DICOM image
-        try:
-            dcm = pydicom.dcmread(infile)
-            self.dcm_count += 1
+        stat = self.stats.pop(infile, None) or os.stat(infile)
+        # Read the Series Description, unless already read by a worker process
+        is_dcm, desc, uid = header or read_description(infile)
         # Return None if the input file is not DICOM format.
-        except(pydicom.errors.InvalidDicomError):
+        if not is_dcm:
+            self.manifest.add(infile, stat, None, 'not_dicom')
             return None
+        self.dcm_count += 1
+
+        # When running incrementally, skip files with the same SOPInstanceUID as a renamed file, for
+        # example when a series is exported again
+        if self.incremental and uid is not None:
+            original = self.manifest.renamed_uid(uid, infile)
+            if original is not None:
+                self.logger.warning('Duplicate SOPInstanceUID: {} already renamed from {}'.format(
+                    os.path.relpath(infile, self.indir), os.path.relpath(original, self.indir)))
+                self.manifest.add(infile, stat, uid, 'duplicate')
+                return None
 
-        # Attempt to store the series description
-        try: 
-            desc = dcm.SeriesDescription.lower()
         # If the dicom file does not contain a tag for SeriesDescription, copy to the 'unnamed' directory
-        except AttributeError:
-            self.copy_unnamed(infile)
+        if desc is None:
+            self.manifest.add(infile, stat, uid, 'unnamed', self.copy_unnamed(infile))
+            return None
 
-        # If the Series Description matches a regular expression in the config file (self.FNAMES)
-        if any([ re.match(regex, desc, flags=re.IGNORECASE) for regex in self.FNAMES ]):
+        # If the Series Description matches a regular expression in the config file
+        category = self.classifier.classify(desc)
+        if category is not None:
             # If the match is for a slice position file, prefix the current filename with the SeriesDescription
-            if re.match(self.config['regex']['SLI_POS'].strip("'"), desc, flags=re.IGNORECASE):
+            if category == 'SLI_POS':
                 outfile = desc + "_" + os.path.basename(infile)
             # Else set the output filename to the DICOM SeriesDescription
             else:
                 outfile =  desc
             # Copy input DICOM to output directory and rename
-            shutil.copy(infile, os.path.join(self.outdir, outfile))
+            self.copy(infile, os.path.join(self.outdir, outfile))
             self.dcm_rename_count += 1
+            self.manifest.add(infile, stat, uid, 'renamed', os.path.join(self.outdir, outfile))
         else:
             # Copy unnamed DCM file to 'unnamed' directory
-            self.copy_unnamed(infile)
+            self.manifest.add(infile, stat, uid, 'unnamed', self.copy_unnamed(infile))
 
 def main(args):
     """
@@ -180,7 +531,7 @@ def main(args):
     # Run MRI file rename protocol using the RenameQA class.
     logger.info('BEGIN')
     logger.info('Input directory is {}, Output directory is {}'.format(opts.i, outdir))
-    RenameQA(opts.i, outdir, unnmdir, config)
+    RenameQA(opts.i, outdir, unnmdir, config, jobs=opts.jobs, link=opts.link, incremental=opts.incremental)
     logger.info('MRI QA rename complete.')
 
 if __name__ == "__main__":
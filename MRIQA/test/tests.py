@@ -1,11 +1,245 @@
 import unittest
 import uniformity
+import rename
+import concurrent.futures
+import configparser
+import csv
+import hashlib
 import sys
 import logging
+import numpy as np
+import os
 import pydicom
+import shutil
+import tempfile
+import threading
+import time
 
 logger = logging.getLogger('test')
 
+# Directory of sample DICOM files, and the config file shipped with the MRI QA modules
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG = os.path.join(TEST_DIR, '..', 'config.ini')
+
+def sample_session(indir, descriptions={}):
+    """Copy the sample DICOM files to indir, and write copies of the first sample file with each
+    SeriesDescription in descriptions (a dict of {filename: description})."""
+    for filename in os.listdir(TEST_DIR):
+        if filename.isdigit():
+            shutil.copy(os.path.join(TEST_DIR, filename), indir)
+    for filename, description in descriptions.items():
+        dcm = pydicom.dcmread(os.path.join(TEST_DIR, '73841016'))
+        dcm.SeriesDescription = description
+        dcm.SOPInstanceUID = pydicom.uid.generate_uid()
+        dcm.save_as(os.path.join(indir, filename))
+
+def read_config():
+    config = configparser.ConfigParser()
+    config.read(CONFIG)
+    return config
+
+def snapshot(directory):
+    """Return a dict of {filename: sha1 digest} for the files in a directory, except the rename
+    manifest."""
+    files = {}
+    for filename in sorted(os.listdir(directory)):
+        path = os.path.join(directory, filename)
+        if os.path.isfile(path) and filename != rename.MANIFEST:
+            with open(path, 'rb') as f:
+                files[filename] = hashlib.sha1(f.read()).hexdigest()
+    return files
+
+
+class RenameTest(unittest.TestCase):
+    """Tests for renaming DICOM files."""
+
+    def setUp(self):
+        self.indir = tempfile.mkdtemp()
+        self.outdir = os.path.join(self.indir, 'renamed')
+        self.unnmdir = os.path.join(self.indir, 'unnamed')
+        os.mkdir(self.outdir)
+        os.mkdir(self.unnmdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.indir)
+
+    def test_classifier(self):
+        # Test that the sample Series Descriptions are classified by their config.ini category, and
+        # that descriptions outside every category (including empty ones) are not matched
+        classifier = rename.Classifier(read_config())
+        categories = {}
+        for filename in os.listdir(TEST_DIR):
+            if filename.isdigit():
+                desc = pydicom.dcmread(os.path.join(TEST_DIR, filename)).SeriesDescription.lower()
+                categories[desc] = classifier.classify(desc)
+        self.assertEqual(categories, {
+            'sli_pos': 'SLI_POS', 'hd_snr_cor_1': 'HEAD_COIL', 'hd_snr_cor_2': 'HEAD_COIL',
+            'hd_snr_sag_1': 'HEAD_COIL', 'hd_snr_sag_2': 'HEAD_COIL', 'hd_snr_tra_1': 'HEAD_COIL',
+            'hd_snr_tra_2': 'HEAD_COIL', 'hd_uni_cor': 'HEAD_COIL', 'hd_uni_sag': 'HEAD_COIL',
+            'hd_uni_tra': 'HEAD_COIL', 'cor_sw': 'SLICE_WIDTH', 'sag_sw': 'SLICE_WIDTH', 'tra_sw': 'SLICE_WIDTH'})
+        for desc in ('other', '', 'x_hd_snr_cor'):
+            self.assertIsNone(classifier.classify(desc))
+        # Test that all sample files are renamed
+        sample_session(self.indir)
+        renamer = rename.RenameQA(self.indir, self.outdir, self.unnmdir, read_config())
+        self.assertEqual((renamer.dcm_rename_count, renamer.dcm_count), (39, 39))
+        self.assertEqual(os.listdir(self.unnmdir), [])
+
+    def test_incremental_links(self):
+        # Two files with the same SeriesDescription: the last renamed is linked from renamed/hd_uni_cor
+        sample_session(self.indir, {'a_file': 'Hd_UNI_cor', 'b_file': 'Hd_UNI_cor'})
+        inputs = snapshot(self.indir)
+        rename.RenameQA(self.indir, self.outdir, self.unnmdir, read_config(), link='sym')
+        self.assertEqual(os.readlink(os.path.join(self.outdir, 'hd_uni_cor')), os.path.join(self.indir, 'b_file'))
+        # Test that an incremental run after a_file changes replaces the link without writing
+        # to the input files, with and without links
+        for link in (None, 'reflink', 'hard'):
+            stat = os.stat(os.path.join(self.indir, 'a_file'))
+            os.utime(os.path.join(self.indir, 'a_file'), (stat.st_atime, stat.st_mtime + 10))
+            rename.RenameQA(self.indir, self.outdir, self.unnmdir, read_config(), link=link, incremental=True)
+            self.assertEqual(snapshot(self.indir), inputs)
+            self.assertEqual(snapshot(self.outdir)['hd_uni_cor'], inputs['a_file'])
+
+    def test_read_header(self):
+        # Test that files without the DICOM preamble are rejected
+        sample = os.path.join(TEST_DIR, '73841016')
+        notes, short = os.path.join(self.indir, 'notes.txt'), os.path.join(self.indir, 'short')
+        with open(notes, 'w') as f:
+            f.write('notes' * 100)
+        with open(short, 'wb') as f:
+            f.write(b'DICM')
+        for infile in (notes, short, os.path.join(self.indir, 'missing')):
+            self.assertFalse(rename.is_dicom(infile))
+            self.assertEqual(rename.read_description(infile), (False, None, None))
+        self.assertTrue(rename.is_dicom(sample))
+        # Test that only the header is read, so that a file truncated within its pixel data is renamed
+        dcm = pydicom.dcmread(sample)
+        header = rename.read_header(sample)
+        self.assertNotIn('PixelData', header)
+        self.assertEqual(header.SeriesDescription, dcm.SeriesDescription)
+        truncated = os.path.join(self.indir, 'truncated')
+        with open(sample, 'rb') as f:
+            data = f.read()
+        with open(truncated, 'wb') as f:
+            f.write(data[:len(data) - len(dcm.PixelData) // 2])
+        self.assertEqual(rename.read_description(truncated),
+                         (True, dcm.SeriesDescription.lower(), str(dcm.SOPInstanceUID)))
+        # Test that DICOM files without a SeriesDescription are read
+        del dcm.SeriesDescription
+        dcm.save_as(os.path.join(self.indir, 'no_desc'))
+        self.assertEqual(rename.read_description(os.path.join(self.indir, 'no_desc')),
+                         (True, None, str(dcm.SOPInstanceUID)))
+        # Test that non-DICOM files are counted but not renamed or copied
+        os.remove(truncated)
+        renamer = rename.RenameQA(self.indir, self.outdir, self.unnmdir, read_config())
+        self.assertEqual((renamer.file_count, renamer.dcm_count, renamer.dcm_rename_count), (3, 1, 0))
+        self.assertEqual(os.listdir(self.unnmdir), ['no_desc'])
+
+    def test_jobs(self):
+        # Test that renaming with several jobs gives the same output as renaming each file in turn,
+        # including which of two files with the same SeriesDescription is renamed last
+        sample_session(self.indir, {'a_file': 'Hd_UNI_cor', 'b_file': 'Hd_UNI_cor', 'c_file': 'other'})
+        with open(os.path.join(self.indir, 'notes.txt'), 'w') as f:
+            f.write('notes')
+        results = []
+        for jobs in (1, 4):
+            outdir = tempfile.mkdtemp()
+            try:
+                renamed, unnamed = os.path.join(outdir, 'renamed'), os.path.join(outdir, 'unnamed')
+                os.mkdir(renamed)
+                os.mkdir(unnamed)
+                renamer = rename.RenameQA(self.indir, renamed, unnamed, read_config(), jobs=jobs)
+                results.append((snapshot(renamed), snapshot(unnamed), renamer.file_count, renamer.dcm_count,
+                                renamer.dcm_rename_count))
+            finally:
+                shutil.rmtree(outdir)
+        self.assertEqual(results[0][2:], (43, 42, 41))
+        self.assertEqual(results[1], results[0])
+
+class OrderedMapTest(unittest.TestCase):
+    """Tests for the bounded process pool map used by uniformity analysis."""
+
+    def test_ordered_map(self):
+        # Test that results are returned in order with no more than window calls in progress
+        lock = threading.Lock()
+        running = [0, 0]
+        def work(i, delay):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(delay)
+            with lock:
+                running[0] -= 1
+            return i
+        delays = [0.02 * (i % 3) for i in range(12)]
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            results = uniformity.ordered_map(pool, work, 3, range(12), delays)
+            self.assertEqual(list(results), list(range(12)))
+        self.assertLessEqual(running[1], 3)
+
+
+class UniformityQATest(unittest.TestCase):
+    """Tests for uniformity analysis of a renamed sample session."""
+
+    def setUp(self):
+        self.indir = tempfile.mkdtemp()
+        self.outdir = tempfile.mkdtemp()
+        self.renamed = os.path.join(self.indir, 'renamed')
+        unnamed = os.path.join(self.indir, 'unnamed')
+        os.mkdir(self.renamed)
+        os.mkdir(unnamed)
+        sample_session(self.indir)
+        rename.RenameQA(self.indir, self.renamed, unnamed, read_config())
+
+    def tearDown(self):
+        shutil.rmtree(self.indir)
+        shutil.rmtree(self.outdir)
+
+    def test_uniformity_files(self):
+        # Test that only files with names matching the UNIFORMITY regular expression (ignoring case)
+        # are analysed. Other files are never read, so files that are not DICOM do not cause errors.
+        shutil.copy(os.path.join(self.renamed, 'hd_uni_cor'), os.path.join(self.renamed, 'HD_UNI_copy.dcm'))
+        for filename in ('notes.txt', 'hd_snr_notes'):
+            with open(os.path.join(self.renamed, filename), 'w') as f:
+                f.write('notes')
+        unif = uniformity.UniformityQA(self.indir, self.outdir, CONFIG, plots=False)
+        self.assertEqual([f.filename for f in unif.files], ['HD_UNI_copy', 'hd_uni_cor', 'hd_uni_sag', 'hd_uni_tra'])
+        names = ('HD_UNI_copy.dcm', 'hd_uni_cor', 'hd_uni_sag', 'hd_uni_tra')
+        self.assertEqual([f.abspath for f in unif.files], [os.path.join(self.renamed, name) for name in names])
+        self.assertEqual(os.listdir(self.outdir), ['uniformity_stats.csv'])
+        with open(os.path.join(self.outdir, 'uniformity_stats.csv')) as f:
+            self.assertEqual(len(list(csv.DictReader(f))), 4)
+
+
+    def test_measure_stack(self):
+        # Stack the sample uniformity images with a copy shifted so that the phantom is cut by the
+        # left edge of the image, and its ROIs extend outside the image
+        images = [pydicom.dcmread(os.path.join(self.renamed, name)).pixel_array
+                  for name in ('hd_uni_cor', 'hd_uni_sag', 'hd_uni_tra')]
+        midx, midy, contour = uniformity.UniformityQA.phantom_midpoint(images[0])
+        shifted = np.zeros_like(images[0])
+        shifted[:, :-midx] = images[0][:, midx:]
+        images.append(shifted)
+        filenames = ['cor', 'sag', 'tra', 'shifted']
+        stack = uniformity.UniformityQA.measure(filenames, np.stack(images))
+        midx, midy, contour = uniformity.UniformityQA.phantom_midpoint(shifted)
+        self.assertLess(midx, 80)
+        # Test that measuring the stack gives the same results as measuring each image
+        for filename, image, stats in zip(filenames, images, stack):
+            single = uniformity.UniformityQA.measure(filename, image)
+            self.assertEqual(sorted(stats), sorted(single))
+            for key in stats:
+                np.testing.assert_array_equal(stats[key], single[key], key)
+            # Test that ROI pixels outside the image are ignored
+            x, y = stats['phantom_xy']
+            central = image[max(y - 10, 0):y + 10, max(x - 10, 0):x + 10]
+            self.assertAlmostEqual(stats['central_roi_mean'], np.mean(central))
+            rows = image[max(y - 5, 0):y + 5].astype(float)
+            profile = [rows[:, col].mean() if 0 <= col < image.shape[1] else np.nan for col in range(x - 80, x + 80)]
+            np.testing.assert_allclose(stats['vertical_roi_profile'], profile)
+        self.assertTrue(np.isnan(stack[3]['vertical_roi_profile'][0]))
+
+
 class UniformityTests(unittest.TestCase):
     def setUp(self):
         # Set test DICOM
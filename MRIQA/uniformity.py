@@ -13,27 +13,142 @@ Created: 30th April 2018
 """
 
 import argparse
+import concurrent.futures
 import configparser
 import collections
 import logging
 import cv2
 import csv
 import os
+import queue
 import re
 import sys
-import matplotlib.pyplot as plt
+import threading
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import pydicom
 import numpy as np
 
-def cli(args):
-    """Configure argument parser."""
+def cli(args, known=False):
+    """Configure argument parser. If known is True, return a tuple of the parsed arguments and a
+    list of the arguments not recognised, as argparse parse_known_args()."""
     parser = argparse.ArgumentParser(description='Rename MRI quality assurance images following UCLH '+
         'medical physics SOP MPB138 (QA ImageHandling)')
     parser.add_argument('-v, --version', action='version', version='{} v1.0'.format(parser.prog))
     parser.add_argument('-i', type=str, metavar='indir', help='Directory containing DICOM files')
     parser.add_argument('-o', type=str, metavar='outdir', help='output directory name')
     parser.add_argument('-c', type=str, metavar='config', help='config file containing filename regular expressions')
-    return parser.parse_args(args)
+    parser.add_argument('--no-plots', action='store_true', help='write the uniformity statistics CSV only')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='jobs',
+        help='number of worker processes analysing images (default: 1)')
+    return parser.parse_known_args(args) if known else parser.parse_args(args)
+
+def to_8bit(image):
+    """Return a uint8 copy of a grayscale image. Pydicom reads images as dtype uint16, however OpenCV
+    requires uint8 format for contour identification. The high byte of each pixel is kept, giving the
+    same image as writing a 16-bit PNG and reading it back with cv2.imread(file, 0).
+    Args:
+        image: A numpy array containing grayscale image data.
+    """
+    if image.dtype == np.uint8:
+        return image.copy()
+    return (np.clip(image, 0, 65535).astype(np.uint16) >> 8).astype(np.uint8)
+
+def measure_file(filename, abspath):
+    """Read a uniformity DICOM file and return its measurements from UniformityQA.measure(), or None if
+    the file is not DICOM format. Called in worker processes when run with more than one job.
+    Args:
+        filename: Output filename prefix
+        abspath: Path of the DICOM file
+    """
+    try:
+        pixel_array = pydicom.dcmread(abspath).pixel_array
+    except(pydicom.errors.InvalidDicomError):
+        return None
+    return UniformityQA.measure(filename, pixel_array)
+
+def ordered_map(pool, func, window, *iterables):
+    """Yield func(*args) for the arguments from iterables in order, as pool.map() does, but with at
+    most window calls submitted to the pool and not yet returned. Results (which hold the measured
+    image) are then kept in memory for only window files at a time, rather than the whole session.
+    Args:
+        pool: concurrent.futures Executor
+        func: Function to call
+        window: Maximum number of calls in progress
+        iterables: Iterables of arguments for func
+    """
+    pending = collections.deque()
+    for args in zip(*iterables):
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(pool.submit(func, *args))
+    while pending:
+        yield pending.popleft().result()
+
+class Renderer(object):
+    """Render report plots and images after the QA measurements have been made. Figures are queued
+    with plot() and image() and drawn in a background thread on a single reused matplotlib figure,
+    so that drawing does not hold up the analysis of the next image. Queueing waits while QUEUE_SIZE
+    figures are waiting to be drawn, which limits the images held in memory.
+
+    Attributes:
+        enabled: If False, queued figures are discarded and no plots are written.
+    """
+    # Maximum number of figures waiting to be drawn
+    QUEUE_SIZE = 8
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.failures = []
+        self.queue = queue.Queue(self.QUEUE_SIZE)
+        self.figure = None
+        self.axes = None
+        self.thread = None
+
+    def plot(self, path, *args):
+        """Queue a line plot, drawn as by matplotlib plot(*args), to be saved to path."""
+        self.put(('plot', path, args))
+
+    def image(self, path, image):
+        """Queue an image array to be saved to path with OpenCV."""
+        self.put(('image', path, image))
+
+    def put(self, job):
+        if not self.enabled:
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.worker, daemon=True)
+            self.thread.start()
+        self.queue.put(job)
+
+    def render(self, job):
+        """Draw and save a queued figure, recording the path and error if it fails."""
+        kind, path, data = job
+        try:
+            if kind == 'image':
+                cv2.imwrite(path, data)
+                return
+            if self.figure is None:
+                self.figure = Figure()
+                FigureCanvasAgg(self.figure)
+                self.axes = self.figure.add_subplot(111)
+            self.axes.clear()
+            self.axes.plot(*data)
+            self.figure.savefig(path)
+        except Exception as error:
+            self.failures.append((path, error))
+
+    def worker(self):
+        while True:
+            self.render(self.queue.get())
+            self.queue.task_done()
+
+    def flush(self):
+        """Wait for all queued figures to be drawn. Returns a list of (path, error) tuples for figures
+        that could not be written."""
+        self.queue.join()
+        failures, self.failures = self.failures, []
+        return failures
 
 class UniformityQA(object):
     """Analyse MRI images according to SOP MB139 Uniformity Protocol.
@@ -41,17 +156,19 @@ class UniformityQA(object):
     Attributes:
         indir: Input directory containing uniformity images
         config: Config file object created by parsing the a config file with configparser.Configparser().
-        files: List of tuples for each uniformity dicom file in the input directory.
-            Format: [(file_prefix, file_path, pydicom_object), ...]
+        files: List of tuples for each uniformity file in the input directory. Images are read from
+            file one at a time during analysis. Format: [(file_prefix, file_path), ...]
 
     """
 
-    def __init__(self, indir, outdir, config):
+    def __init__(self, indir, outdir, config, plots=True, jobs=1):
         """Initialise object with input directory and configuration file.
 
         Args:
             indir: Input directory containing uniformity images
             config: config.ini file containing regular expression for uniformity file
+            plots: If False, only the uniformity statistics CSV is written
+            jobs: Number of worker processes analysing images. Results are written in file order.
         """ 
         self.indir = indir
         self.config = configparser.ConfigParser()
@@ -59,12 +176,20 @@ class UniformityQA(object):
         self.files = self.uniformity_files(self.indir)
         self.logger = logging.getLogger('mriqa.uniformityObject')
         self.outdir = outdir
-
-        # Run Uniformity QA protocol
-        for UniformityTuple in self.files:
-            self.logger.info('Reading file: {}'.format(UniformityTuple.filename))
-            uniformity_stats = self.measure(UniformityTuple.filename, UniformityTuple.pydicom.pixel_array)
-            self.write(uniformity_stats)
+        self.renderer = Renderer(enabled=plots)
+
+        # Run Uniformity QA protocol. Plots are drawn in the background while later files are measured.
+        filenames = [UniformityTuple.filename for UniformityTuple in self.files]
+        paths = [UniformityTuple.abspath for UniformityTuple in self.files]
+        if jobs > 1:
+            # Measure images in worker processes, two per process at a time. Results are returned in
+            # file order.
+            with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+                self.write_all(filenames, paths, ordered_map(pool, measure_file, 2 * jobs, filenames, paths))
+        else:
+            self.write_all(filenames, paths, map(measure_file, filenames, paths))
+        for path, error in self.renderer.flush():
+            self.logger.error('Unable to write {}: {}'.format(path, error))
 
     def uniformity_files(self, indir):
         """Find the filenames and absolute paths of uniformity images in the input directory.
@@ -72,48 +197,56 @@ class UniformityQA(object):
             indir: Directory containing uniformity DICOM images. Uniformity images are recognised by
             a regular expression in the 'config.ini' file under the keys [analysis][UNIFORMITY].
         Returns:
-            A list of namedtuples mapping filenames, absolute filepaths and dicom objects. For example:
-            (('hd_uni_cor', 'C:\\User\\hd_uni_cor.dcm', <class 'pydicom.dataset.FileDataset'>), ...)"""
+            A list of namedtuples mapping filenames and absolute filepaths, in sorted order. For example:
+            (('hd_uni_cor', 'C:\\User\\hd_uni_cor.dcm'), ...)"""
         
-        # Get the uniformity regular expression string from the config file object
-        uniformity_regex = self.config['analysis']['UNIFORMITY']
+        # Compile the uniformity regular expression string from the config file object
+        uniformity_regex = re.compile(self.config['analysis']['UNIFORMITY'], re.IGNORECASE)
 
         # Initialise a named tuple to store individual dicom file data
-        UnifFiles = collections.namedtuple('uniformity_files',['filename','abspath','pydicom'])
+        UnifFiles = collections.namedtuple('uniformity_files',['filename','abspath'])
         # Initialise a list to store uniformity file tuples. This list is returned by the function.
         file_data_tuples = []
 
         # Loop through the input directory file tree 
         dirtree = os.walk(os.path.join(indir, 'renamed'))
         for path,dirs,filenames in dirtree:
+            dirs.sort()
             # For every file in the input directory
-            for filename in filenames:
-                # Add details to uniformity_files if valid uniformity DICOM file.
-                try:
+            for filename in sorted(filenames):
+                # Add file data to list of tuples returned by function if filename matches uniformity
+                # regular expression. Files are not read until they are analysed.
+                if uniformity_regex.match(filename):
                     fname = os.path.basename(os.path.splitext(filename)[0])
                     fullpath = os.path.abspath(os.path.join(path, filename))
-                    pydicom_object = pydicom.dcmread(fullpath)
-                    # Add file data to list of tuples returned by function if filename matches 
-                    # uniformity regular expression.
-                    if re.match(uniformity_regex, filename, re.IGNORECASE):
-                        file_data_tuples.append(UnifFiles(fname, fullpath, pydicom_object))
-                # Skip if the input file is not DICOM format.
-                except(pydicom.errors.InvalidDicomError):
-                    pass
+                    file_data_tuples.append(UnifFiles(fname, fullpath))
         return file_data_tuples
 
-    def phantom_midpoint(self, image):
+    def write_all(self, filenames, paths, results):
+        """Write the measurements for each uniformity file, in file order.
+        Args:
+            filenames: Output filename prefix of each file
+            paths: Path of each file
+            results: Iterable of measurements returned by measure_file() for each file
+        """
+        for filename, path, uniformity_stats in zip(filenames, paths, results):
+            self.logger.info('Reading file: {}'.format(filename))
+            # Skip if the input file is not DICOM format.
+            if uniformity_stats is None:
+                self.logger.warning('Skipping non-DICOM file: {}'.format(path))
+                continue
+            self.write(uniformity_stats)
+
+    @staticmethod
+    def phantom_midpoint(image):
         """Return midpoint of the largest contour in an image, along with contour object
         Args:
             image: A numpy array containing grayscale image data.
         Returns:
             (x, y, contour) where x,y are coordinates of largest contour midpoint.
         """
-        # Write and read image for processing. Pydicom reads images as dtype uint16, however OpenCV
-        # requires uint8 format for contour identification. This write-read process achieves that.
-        tempfile = os.path.join(self.outdir, '__temp.png')
-        cv2.imwrite(tempfile, image)
-        image_8bit = cv2.imread(tempfile, 0)
+        # Convert image to 8-bit for contouring
+        image_8bit = to_8bit(image)
         # Threshold image for contouring
         ret,thresh = cv2.threshold(image_8bit,0,255,cv2.THRESH_BINARY+cv2.THRESH_OTSU)
         # Get contours.
@@ -125,85 +258,106 @@ class UniformityQA(object):
         midx, midy = (int(M['m10']/M['m00']), int(M['m01']/M['m00']))
         return(midx, midy, img_contour)
 
-    def measure(self, filename, pydicom_image):
+    @staticmethod
+    def roi(images, midx, midy, half_width, half_height):
+        """Return rectangular ROIs of size (2*half_height, 2*half_width) centred on the phantom midpoint
+        in each image of a stack. For top-left (x1,y1) and bottom-right (x2,y2) coordinates, the ROI is
+        Image[y1:y2, x1:x2].
+        Args:
+            images: Numpy array (N, H, W) of images
+            midx, midy: Numpy arrays (N,) of ROI centre coordinates
+            half_width, half_height: Half the ROI size in pixels
+        Returns:
+            A tuple (rois, inside). rois is a float array (N, 2*half_height, 2*half_width). If inside is
+            False, some ROIs extend outside their image and those pixels are NaN.
+        """
+        rows = midy[:, np.newaxis] + np.arange(-half_height, half_height)
+        cols = midx[:, np.newaxis] + np.arange(-half_width, half_width)
+        # Gather all ROIs at once, clipping pixel indices to the image
+        rois = images[np.arange(len(images))[:, np.newaxis, np.newaxis],
+            np.clip(rows, 0, images.shape[1] - 1)[:, :, np.newaxis],
+            np.clip(cols, 0, images.shape[2] - 1)[:, np.newaxis, :]].astype(float)
+        # Mask pixels that are outside the image
+        outside = ((rows < 0) | (rows >= images.shape[1]))[:, :, np.newaxis] | \
+            ((cols < 0) | (cols >= images.shape[2]))[:, np.newaxis, :]
+        rois[outside] = np.nan
+        return rois, not outside.any()
+
+    @staticmethod
+    def measure(filename, pydicom_image):
         """Return measurement statistics from an MRI image for uniformity analysis.
         Arguments:
-            filename - String containing the output filename prefix
-            pydicom_image -  Numpy array (uint16) from pydicom.dcmread()
+            filename - String containing the output filename prefix, or a list of N prefixes
+            pydicom_image -  Numpy array (uint16) from pydicom.dcmread(), or a stack (N, H, W) of images
         Returns:
-            A dict containing QA measurements from the input pydicom image.
+            A dict containing QA measurements from the input pydicom image, or a list of N dicts for
+            a stack of images (see measure_stack()).
             Keys: filename, dimensions, midpoint, central_roi_mean, vertical_roi_profile, 
                 fraction, fraction uniformity
         """
+        if pydicom_image.ndim == 3:
+            return UniformityQA.measure_stack(filename, pydicom_image)
+        return UniformityQA.measure_stack([filename], pydicom_image[np.newaxis])[0]
 
-        # Calculate the midpoint of the phantom in the DICOM image.
-        midx, midy, contour = self.phantom_midpoint(pydicom_image)
-
-        # Calculate the central ROI mean
-        # For top-left (x1,y1) and bottom-right (x2,y2) coordinates of a rectangular ROI,
-        # ROI = Image[y1:y2, x1:x2] where Image is a numpy array.
-        central_roi = pydicom_image[midy-10:midy+10, midx-10:midx+10]
-        central_roi_mean = np.mean(central_roi)
-        
-        # Calculate the vertical ROI profile values
-        # Slice the vertical ROI (160x10) from the image
-        vertical_roi = pydicom_image[midy-5:midy+5, midx-80:midx+80]
-        # Loop through the vertical ROI y-axis values and calculate the averages
-        profile_data = ([np.average(vertical_roi[:,i]) for i in range(vertical_roi.shape[1])])
+    @staticmethod
+    def measure_stack(filenames, images):
+        """Return measurement statistics for a stack of MRI images of the same size, measured together.
+        Arguments:
+            filenames - List of N output filename prefixes
+            images - Numpy array (N, H, W) of images
+        Returns:
+            A list of N dicts containing QA measurements for each image, as returned by measure().
+        """
+        # Calculate the midpoint of the phantom in each DICOM image.
+        midpoints = [UniformityQA.phantom_midpoint(image) for image in images]
+        midx = np.array([midpoint[0] for midpoint in midpoints])
+        midy = np.array([midpoint[1] for midpoint in midpoints])
+        index = np.arange(len(images))
+
+        # Calculate the central ROI means (20x20). Pixels outside the image are ignored.
+        central_roi, inside = UniformityQA.roi(images, midx, midy, 10, 10)
+        mean = np.mean if inside else np.nanmean
+        central_roi_mean = mean(central_roi, axis=(1, 2))
+
+        # Calculate the vertical ROI profile values. These are the averages of each column of the
+        # vertical ROI (160x10).
+        vertical_roi, inside = UniformityQA.roi(images, midx, midy, 80, 5)
+        mean = np.mean if inside else np.nanmean
+        profile_data = mean(vertical_roi, axis=1)
 
         # Measure the fraction and fraction uniformity
         # Calculate the the aboslute difference between each vertical profile and the central ROI mean.
-        abs_dif = list(map(lambda x: abs(x - central_roi_mean), profile_data))
+        abs_dif = np.abs(profile_data - central_roi_mean[:, np.newaxis])
         # Get the fraction count. This is the number of profiles where abs_diff < (profile_mean *0.1)
-        fraction = sum([ (diff < (profile*0.1)) for profile, diff in zip(profile_data, abs_dif)])
+        fraction = np.count_nonzero(abs_dif < profile_data * 0.1, axis=1)
         fraction_uniformity = fraction/160
 
         # Calculate horizontal and vertical single line profiles
-        horizontal_profile = [pydicom_image[midy,x] for x in range(pydicom_image.shape[1])]
-        vertical_profile = [pydicom_image[y, midx] for y in range(pydicom_image.shape[0])]
-
-        # Create and return a dict of relevant QA statistics
-        uniformity_stats = {
-            "filename": filename, 
-            "dimensions": pydicom_image.shape,
-            "phantom_xy": (midx, midy),
-            "central_roi_mean": central_roi_mean,
-            "fraction": fraction,
-            "fraction_uniformity": fraction_uniformity,
-            "vertical_roi_profile": profile_data,
-            "horizontal_sl_profile": horizontal_profile,
-            "vertical_sl_profile": vertical_profile,
-            "image": pydicom_image,
-            "contour": contour
-            }
-
-        return uniformity_stats
+        horizontal_profile = images[index, midy, :]
+        vertical_profile = images[index, :, midx]
+
+        # Create and return a dict of relevant QA statistics for each image
+        return [{
+            "filename": filenames[i], 
+            "dimensions": images.shape[1:],
+            "phantom_xy": (int(midx[i]), int(midy[i])),
+            "central_roi_mean": central_roi_mean[i],
+            "fraction": int(fraction[i]),
+            "fraction_uniformity": fraction_uniformity[i],
+            "vertical_roi_profile": profile_data[i].tolist(),
+            "horizontal_sl_profile": horizontal_profile[i].tolist(),
+            "vertical_sl_profile": vertical_profile[i].tolist(),
+            "image": images[i],
+            "contour": midpoints[i][2]
+            } for i in index]
 
     def write(self, stats):
-        """Generate plots and tables for uniformity QA report.
+        """Generate plots and tables for uniformity QA report. Plots are queued on self.renderer.
         Args:
             stats: A dictionary of image QA measurements returned by UniformityQA.measure(). 
         """
-        # Generate a plot of the image with ROIs drawn
-        tempfile = os.path.join(self.outdir, '__temp.png')
-        cv2.imwrite(tempfile, stats["image"])
-        ROI_image = cv2.imread(tempfile, 0)
-        midx, midy = stats["phantom_xy"]
-        contour = stats["contour"]
-        cv2.rectangle(ROI_image, (midx-10,midy-10), (midx+10, midy+10), (255,255,255), 1)
-        cv2.rectangle(ROI_image, (midx-80,midy-5), (midx+80, midy+5), (255,255,255), 1)
-        cv2.line(ROI_image, (midx, 0), (midx, ROI_image.shape[1]), (255,0,0), 1)
-        cv2.line(ROI_image, (0, midy), (ROI_image.shape[1], midy), (255,0,0), 1)
-        cv2.drawContours(ROI_image, [contour], 0, (255,255,255), 1)
-        ROI_outfile = os.path.join(self.outdir, (stats['filename'] + '_imageROIs.png')) 
-        cv2.imwrite(ROI_outfile, ROI_image)
-
-        # Draw charts for each of the uniformity profiles
-        for profile in [key for key in stats.keys() if key.endswith('profile')]:
-            plt.plot(stats[profile])
-            plot_outfile = os.path.join(self.outdir, (stats['filename'] + '_' + profile + '.png'))
-            plt.savefig(plot_outfile)
-            plt.gcf().clear()
+        if self.renderer.enabled:
+            self.write_plots(stats)
 
         # Set output CSV file path and check if it exists
         stats_outfile = os.path.join(self.outdir, 'uniformity_stats.csv')
@@ -217,6 +371,28 @@ class UniformityQA(object):
             else:
                 writer.writerow(stats)
 
+    def write_plots(self, stats):
+        """Queue the ROI image and uniformity profile plots for the QA report.
+        Args:
+            stats: A dictionary of image QA measurements returned by UniformityQA.measure(). 
+        """
+        # Generate a plot of the image with ROIs drawn
+        ROI_image = to_8bit(stats["image"])
+        midx, midy = stats["phantom_xy"]
+        contour = stats["contour"]
+        cv2.rectangle(ROI_image, (midx-10,midy-10), (midx+10, midy+10), (255,255,255), 1)
+        cv2.rectangle(ROI_image, (midx-80,midy-5), (midx+80, midy+5), (255,255,255), 1)
+        cv2.line(ROI_image, (midx, 0), (midx, ROI_image.shape[1]), (255,0,0), 1)
+        cv2.line(ROI_image, (0, midy), (ROI_image.shape[1], midy), (255,0,0), 1)
+        cv2.drawContours(ROI_image, [contour], 0, (255,255,255), 1)
+        ROI_outfile = os.path.join(self.outdir, (stats['filename'] + '_imageROIs.png')) 
+        self.renderer.image(ROI_outfile, ROI_image)
+
+        # Queue charts for each of the uniformity profiles
+        for profile in [key for key in stats.keys() if key.endswith('profile')]:
+            plot_outfile = os.path.join(self.outdir, (stats['filename'] + '_' + profile + '.png'))
+            self.renderer.plot(plot_outfile, stats[profile])
+
 
 def main(args):
     # Setup logging. Calls to logger.info('string') will print 'string' to the console.
@@ -241,7 +417,7 @@ def main(args):
         exit()
 
     # Run Uniformity QA protocol
-    UniformityQA(opts.i, outdir, opts.c)
+    UniformityQA(opts.i, outdir, opts.c, plots=not opts.no_plots, jobs=opts.jobs)
     logger.info('Uniformity protocol complete')
 
 
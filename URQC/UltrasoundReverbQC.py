@@ -9,25 +9,53 @@ python3 UltrasoundReverbQC.py -i INPUT [-o OUTPREFIX]
 Author(s) : Nana Mensah <Nana.mensah1@nhs.net>
 Created : 11 April 2018
 """
-from matplotlib import pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import argparse
+import concurrent.futures
+import contextlib
 import csv
 import cv2
-import itertools
+import functools
+import hashlib
+import json
 import numpy as np
 import os
 import pydicom
+import queue
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+import zipfile
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 class Contour(object):
     """OpenCV contour object for the Ultrasound reverberation pattern.
 
     Args:
         img(array): Binary image produced by thresholding.
+        pyramid(bool): Select the contour on a downsampled image if the image is larger than
+            PYRAMID_SIZE, then trace only the selected contour at full resolution.
     """
+    # Minimum area of reverberation patterns spanning the majority of the image, as a fraction of
+    # the image area (approximately 200,000 units for a 1024x768 image)
+    LARGE_AREA_FRACTION = 0.25
+    # Images are halved until their longest side is at most PYRAMID_SIZE for contour selection
+    PYRAMID_SIZE = 1024
+    # Margin (downsampled pixels) around the selected contour traced at full resolution
+    PYRAMID_MARGIN = 4
 
-    def __init__(self, img):
+    def __init__(self, img, pyramid=True):
         """Initialise class with a binary image produced by thresholding."""
         self.image = img
+        self.pyramid = pyramid
         self.UScontour = self.find_contour()
 
     @staticmethod
@@ -39,13 +67,58 @@ class Contour(object):
     def find_contour(self):
         """Return the OpenCV contour object containing the ultrasound reverbation pattern.
         From all possible contours, this selection is based on the following criteria:
-        - A contour area of >200,000 units.
+        - A contour area of > LARGE_AREA_FRACTION of the image area.
         - The first contour with an aspect ratio between 2 and 5.
+        Large images are downsampled for selection when Contour.pyramid is set (see Contour.refine()).
         """
+        scale = self.pyramid_scale() if self.pyramid else 1
+        if scale == 1:
+            return self.select(self.image, cv2.CHAIN_APPROX_NONE)
+        # Halve the image for each pyramid level (much faster than a single resize by scale), then
+        # select the contour on the downsampled image from pixels mostly inside the pattern
+        small = self.image
+        for level in range(scale.bit_length() - 1):
+            small = cv2.resize(small, (small.shape[1] // 2, small.shape[0] // 2), interpolation=cv2.INTER_AREA)
+        ret, small = cv2.threshold(small, 127, 255, cv2.THRESH_BINARY)
+        return self.refine(self.select(small, cv2.CHAIN_APPROX_SIMPLE), scale)
+
+    def pyramid_scale(self):
+        """Return the downsampling factor (a power of 2) bringing the longest image side to at most
+        PYRAMID_SIZE."""
+        scale = 1
+        while max(self.image.shape[:2]) > self.PYRAMID_SIZE * scale:
+            scale *= 2
+        return scale
+
+    def refine(self, cont, scale):
+        """Return the full resolution contour of a contour selected on an image downsampled by scale.
+        Only the region around the selected contour is traced. The whole image is searched if the
+        contour found is clipped by that region."""
+        x, y, w, h = cv2.boundingRect(cont)
+        y_max, x_max = self.image.shape
+        margin = self.PYRAMID_MARGIN
+        x0, y0 = max((x - margin) * scale, 0), max((y - margin) * scale, 0)
+        x1, y1 = min((x + w + margin) * scale, x_max), min((y + h + margin) * scale, y_max)
+        im, contours, heirarchy = cv2.findContours(np.ascontiguousarray(self.image[y0:y1, x0:x1]),
+                                                   cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(x0, y0))
+        if contours:
+            full = max(contours, key=cv2.contourArea)
+            # Check the contour does not reach an edge of the region inside the image
+            xs, ys = full[:, 0, 0], full[:, 0, 1]
+            clipped = ((x0 > 0 and xs.min() == x0) or (y0 > 0 and ys.min() == y0) or
+                       (x1 < x_max and xs.max() == x1 - 1) or (y1 < y_max and ys.max() == y1 - 1))
+            if not clipped:
+                return full
+        return self.select(self.image, cv2.CHAIN_APPROX_NONE)
+
+    def select(self, image, method):
+        """Return the contour of the reverberation pattern from a binary image, using the criteria
+        described in Contour.find_contour(). Contour points are approximated using method, an OpenCV
+        contour approximation flag."""
 
         # Call OpenCV findContours to generate a list of contour objects
-        im, contours, heirarchy = cv2.findContours(self.image, cv2.RETR_EXTERNAL,
-                                                   cv2.CHAIN_APPROX_NONE)
+        im, contours, heirarchy = cv2.findContours(image, cv2.RETR_EXTERNAL, method)
+        min_area = self.LARGE_AREA_FRACTION * image.shape[0] * image.shape[1]
 
         # Create a list of tuples for each contour (contour, aspect_ratio, contourArea),
         # arranged by countourArea in descending order
@@ -53,9 +126,9 @@ class Contour(object):
                            key=lambda x: x[2], reverse=True)
 
         # Filter sorted contour list for contours with aspect ratio < 10 (to ignore vendor headband
-        # which lies ~17) and contourArea > 200000. This filter selects high-quality reverberation
+        # which lies ~17) and contourArea > min_area. This filter selects high-quality reverberation
         # patterns that span the majority of the image.
-        large_area_bool = list(filter(lambda x: (x[1] < 10) and (x[2] > 200000), cont_list))
+        large_area_bool = list(filter(lambda x: (x[1] < 10) and (x[2] > min_area), cont_list))
 
         # Filter sorted contour list for contours with aspect ratio to between 2 and 5. The aspect
         # ratio for reverbration patterns in test images were approximately 3.33.
@@ -119,38 +192,1025 @@ class Contour(object):
         return point_dict
 
 
+class LinearContour(Contour):
+    """OpenCV contour object for the rectangular reverberation pattern of a linear array probe.
+
+    Args:
+        img(array): Binary image produced by thresholding.
+    """
+    # Minimum fraction of the bounding rectangle filled by a linear reverberation pattern contour
+    RECT_FILL = 0.8
+
+    @staticmethod
+    def fill_ratio(cont):
+        """Calculates the fraction of the bounding rectangle of an OpenCV contour object filled by the contour."""
+        x, y, w, h = cv2.boundingRect(cont)
+        return cv2.contourArea(cont) / float(w * h)
+
+    def find_contour(self):
+        """Return the OpenCV contour object containing the ultrasound reverbation pattern. This is the
+        largest contour that fills at least RECT_FILL of its bounding rectangle, ignoring the vendor
+        headband (aspect ratio >= 10). Returns the largest contour if none is rectangular.
+        """
+        im, contours, heirarchy = cv2.findContours(self.image, cv2.RETR_EXTERNAL,
+                                                   cv2.CHAIN_APPROX_NONE)
+        cont_list = sorted(contours, key=cv2.contourArea, reverse=True)
+        rectangular = [cont for cont in cont_list
+                       if self.aspect_ratio(cont) < 10 and self.fill_ratio(cont) >= self.RECT_FILL]
+        return rectangular[0] if rectangular else cont_list[0]
+
+    @property
+    def points(self):
+        """Return a dictionary of the midpoint and corners of the contour bounding rectangle. The
+        left and right points are the bottom corners, as for curved array contours."""
+        x, y, w, h = cv2.boundingRect(self.UScontour)
+        return {'mid': (x + w // 2, y + h // 2), 'top-left': (x, y), 'top-right': (x + w - 1, y),
+                'left': (x, y + h - 1), 'right': (x + w - 1, y + h - 1)}
+
+
+class SweepData(object):
+    """Compact storage for the pixel values read at each step of the reverb sweep.
+
+    Pixel values for all steps are held in a single flat array, with the values for step i found at
+    values[offsets[i]:offsets[i+1]]. Indexing or iterating returns (radians, pixel values) tuples.
+
+    Args:
+        rads (array): Radians value of each sweep step.
+        values (array): Pixel values (uint8) for all steps, concatenated in sweep order.
+        counts (array): Number of pixel values read at each step.
+    """
+
+    def __init__(self, rads, values, counts):
+        self.rads = np.asarray(rads, dtype=float)
+        self.values = np.asarray(values, dtype=np.uint8)
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    def __len__(self):
+        return len(self.rads)
+
+    def __getitem__(self, step):
+        if isinstance(step, slice):
+            return [self[i] for i in range(len(self))[step]]
+        step = range(len(self))[step]
+        return self.rads[step], self.values[self.offsets[step]:self.offsets[step + 1]]
+
+    def __iter__(self):
+        for step in range(len(self)):
+            yield self[step]
+
+    @property
+    def counts(self):
+        """Array of the number of pixel values read at each step."""
+        return np.diff(self.offsets)
+
+    def padded(self):
+        """Return a 2D array (steps, max count) of pixel values, with each step padded by trailing 0s."""
+        counts = self.counts
+        padded = np.zeros((len(self), counts.max() if len(counts) else 0), dtype=self.values.dtype)
+        # Row and column index of each value in the flat values array
+        rows = np.repeat(np.arange(len(self)), counts)
+        cols = np.arange(len(self.values)) - np.repeat(self.offsets[:-1], counts)
+        padded[rows, cols] = self.values
+        return padded
+
+    def depth_data(self):
+        """Create data for depth calculations and plots. Emulates reading linear array horizontally.
+        Returns a dict with the depth matrix (data), an array with shape (rows, depth) where each
+        row holds the pixel values at the same distance along every sweep step, the average of each
+        row (avg), and the number of steps (depth) and rows (rows) read.
+        """
+        # Get a 2D array of pixel values for each sweep step, padded with trailing 0s
+        pixels = self.padded()
+        nonzero = pixels != 0
+        width = pixels.shape[1]
+
+        # Find the first and last non-zero pixel of each step. Leading and trailing 0 values are
+        # the empty pixels read from the masked image. Steps with no non-zero pixels are empty.
+        first = np.argmax(nonzero, axis=1)
+        last = width - 1 - np.argmax(nonzero[:, ::-1], axis=1)
+        lengths = np.where(nonzero.any(axis=1), last - first + 1, 0)
+
+        # Read each stripped step in reverse, to account for reading of the line in reverse in
+        # SweepGeometry.sweep(). Index j of a step is the pixel at last - j, or 0 past the step length.
+        index = np.arange(lengths.max() if len(lengths) else 0)
+        cols = last[:, np.newaxis] - index[np.newaxis, :]
+        valid = index[np.newaxis, :] < lengths[:, np.newaxis]
+        stripped = np.where(valid, pixels[np.arange(len(pixels))[:, np.newaxis], np.clip(cols, 0, None)], 0)
+
+        # Transpose such that each value is stored with others of the same index
+        transp = stripped.T
+
+        # Get the average for each value.
+        depth_avg = transp.mean(axis=1)
+
+        # Get the maximum depth and rows read
+        us_depth, rows = transp.shape[1], transp.shape[0]
+
+        return {'data': transp, 'avg': depth_avg, 'depth': us_depth, 'rows': rows}
+
+
+class SweepGeometry(object):
+    """Sampling geometry of the reverb sweep. Coordinates on the line parallel to the contour left
+    edge are rotated clockwise about the edge line intersect in steps of RADS radians, until the line
+    no longer crosses the dilated contour mask. The geometry depends only on the contour, so it can be
+    reused to sample other images taken with the same probe position.
+
+    Args:
+        points (dict): Contour corner points and edge line intersect from Contour.points.
+        roi (tuple): Region of interest (x0, y0, x1, y1) containing the contour mask.
+        region (np.ndarray): Binary mask of the reverberation pattern, cropped to roi.
+        width (int): Width of the full input image. Sets the length of the left edge line.
+        keep_coords (bool): Store the coordinates of each step in SweepGeometry.coords.
+
+    Attributes:
+        rads (np.ndarray): Radians value of each sweep step.
+        index (np.ndarray): Array (int32) with shape (steps, points) of flat indices into the region
+            of interest for each coordinate. Coordinates outside of the region of interest are -1.
+        coords (np.ndarray): Array (float32) of coordinates with shape (steps, points, 2), or None.
+    """
+
+    # Set the radians value to rotate by
+    RADS = 0.004
+    # Set the number of rotation steps computed together in each batch of the sweep
+    CHUNK = 128
+
+    def __init__(self, points, roi, region, width, keep_coords=True):
+        self.roi = roi
+        self.rads, self.index, self.coords = self.sweep(points, region, width, keep_coords)
+
+    @classmethod
+    def from_arrays(cls, roi, rads, index):
+        """Return a SweepGeometry object from previously computed radians and index arrays, without
+        coordinates. Used to restore geometry from a GeometryCache."""
+        geometry = cls.__new__(cls)
+        geometry.roi = tuple(int(i) for i in roi)
+        geometry.rads, geometry.index, geometry.coords = rads, index, None
+        return geometry
+
+    def sweep(self, points, region, width, keep_coords=True):
+        """Return the radians, region of interest indices and (if keep_coords) coordinates of each
+        step of the sweep. Only points of the left edge line that pass through the region of interest
+        are used."""
+        x0, y0, x1, y1 = self.roi
+        ox, oy = points['ins']
+        # Flat binary mask of the region of interest
+        flat_region = region.ravel() > 0
+
+        def locate(xs, ys):
+            """Return flat region of interest indices for a (steps x points) array of coordinates.
+            Coordinates that fall outside of the region of interest are set to -1."""
+            inside = (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+            # Note img[y,x] slicing versus (x,y) coordinate. Indices are offset by the roi origin.
+            rows = np.where(inside, ys, y0).astype(int) - y0
+            cols = np.where(inside, xs, x0).astype(int) - x0
+            return np.where(inside, rows * (x1 - x0) + cols, -1).astype(np.int32)
+
+        def crosses(index):
+            """Return a boolean array, True for each step with a coordinate in the contour mask."""
+            return np.any((index >= 0) & flat_region[index], axis=1)
+
+        # Get cooefficients of the left edge line equation
+        zip_ledge = list(zip(points['left'], points['top-left']))
+        gradient, y_int = (np.polyfit(zip_ledge[0], zip_ledge[1], 1))
+        # Get arrays of left edge coordinates (x, y)
+        ledge_x = np.arange(width, dtype=float)
+        ledge_y = gradient * ledge_x + y_int
+
+        # Rotation preserves the distance of each point from the edge line intersect. Keep only the
+        # left edge coordinates within the range of distances from the intersect to the region of
+        # interest, as all other points never enter it. A 1 pixel tolerance allows for rounding.
+        corners = np.array([(x0, y0), (x1, y0), (x0, y1), (x1, y1)], dtype=float)
+        r_max = np.max(np.hypot(corners[:, 0] - ox, corners[:, 1] - oy)) + 1
+        r_min = np.hypot(ox - np.clip(ox, x0, x1), oy - np.clip(oy, y0, y1)) - 1
+        radius = np.hypot(ledge_x - ox, ledge_y - oy)
+        in_range = (radius >= r_min) & (radius <= r_max)
+        ledge_x, ledge_y = ledge_x[in_range], ledge_y[in_range]
+        dx, dy = ledge_x - ox, ledge_y - oy
+
+        # Rotate the left edge coordinates by multiples of the RADS value across the reverb image.
+        # This moves the "line" of coordinates from the left edge to the right. The start
+        # coordinates are stored unrotated.
+        rads_list = [np.zeros(1)]
+        index_list = [locate(ledge_x[np.newaxis, :], ledge_y[np.newaxis, :])]
+        coord_list = [np.stack((ledge_x, ledge_y), axis=-1)[np.newaxis].astype(np.float32)]
+        nrads = 0.0
+        # Stop after the first step that does not cross the contour mask, or after a full turn
+        while crosses(index_list[-1][-1:])[0] and nrads < 2 * np.pi:
+            # Cumulative radians, summed sequentially from the last step of the previous batch
+            rads = np.cumsum(np.concatenate(([nrads], np.full(self.CHUNK, self.RADS))))[1:]
+            cos, sin = np.cos(rads)[:, np.newaxis], np.sin(rads)[:, np.newaxis]
+            xs = ox + cos * dx + sin * dy
+            ys = oy - sin * dx + cos * dy
+            index = locate(xs, ys)
+            # Truncate the batch at the first step that does not cross the contour mask
+            empty = np.flatnonzero(~crosses(index))
+            end = empty[0] + 1 if empty.size else len(rads)
+            rads_list.append(rads[:end])
+            index_list.append(index[:end])
+            if keep_coords:
+                coord_list.append(np.stack((xs[:end], ys[:end]), axis=-1).astype(np.float32))
+            nrads = rads[end - 1]
+
+        coords = np.concatenate(coord_list) if keep_coords else None
+        return np.concatenate(rads_list), np.concatenate(index_list), coords
+
+    def sample(self, image):
+        """Read the pixel values of a masked image of the region of interest at each sweep step, up to
+        and including the first step where all pixel values are 0.
+        Args:
+            image (np.ndarray): Masked image cropped to the region of interest, from USimg.maskimg().
+        Returns:
+            A tuple (us_data, us_avgs). us_data is a SweepData object of radians and pixel values.
+            us_avgs is a list of radians and the average of non-zero pixel values.
+        """
+        inside = self.index >= 0
+        pixels = np.where(inside, image.ravel()[self.index], 0).astype(image.dtype)
+
+        # Truncate the sweep at the first step where all pixel values are 0
+        empty = np.flatnonzero(pixels.sum(axis=1) == 0)
+        end = empty[0] + 1 if empty.size else len(pixels)
+        rads, inside, pixels = self.rads[:end], inside[:end], pixels[:end]
+
+        # Calculate the average of non-zero pixel values for each step. Steps without non-zero
+        # values have an average of nan.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avgs = pixels.sum(axis=1) / np.count_nonzero(pixels, axis=1)
+
+        return SweepData(rads, pixels[inside], inside.sum(axis=1)), list(zip(rads, avgs))
+
+
+class GeometryCache(object):
+    """Persistent on-disk cache of the mask region and sampling geometry computed for a contour.
+    The probe and depth setting rarely change between QA sessions, so images from the same probe can
+    reuse the geometry and skip straight to pixel sampling. Entries are keyed by the image shape and
+    the contour corner points, quantized to QUANTUM pixels. Each entry is stored as a .npz file. The
+    least recently used entries are removed when the cache holds more than max_entries.
+
+    Args:
+        directory (str): Cache directory. Created if it does not exist.
+        max_entries (int): Maximum number of cached geometries.
+    """
+
+    # Pixel size used to quantize contour corner points for cache keys
+    QUANTUM = 4
+    # Version of the cached data. Increment if the geometry calculation changes.
+    VERSION = 1
+
+    def __init__(self, directory, max_entries=32):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, shape, points):
+        """Return the cache key for an image shape and dict of contour points (see Contour.points)."""
+        corners = [points[i] for i in ['left', 'right', 'top-left', 'top-right']]
+        quantized = [int(round(v / self.QUANTUM)) for point in corners for v in point]
+        values = [self.VERSION, SweepGeometry.RADS, USimg.MASK_KERNEL, USimg.MASK_ITERATIONS]
+        return hashlib.sha1(repr(values + list(shape) + quantized).encode()).hexdigest()
+
+    def path(self, key):
+        """Return the path of the cache file for a key."""
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """Return a tuple (roi, region, geometry) for a cache key, or None if the key is not cached."""
+        path = self.path(key)
+        try:
+            with np.load(path) as cached:
+                roi = tuple(int(i) for i in cached['roi'])
+                region = cached['region']
+                geometry = SweepGeometry.from_arrays(roi, cached['rads'], cached['index'])
+        # Treat missing or unreadable entries as not cached
+        except (IOError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return None
+        # Mark the entry as recently used
+        os.utime(path)
+        return roi, region, geometry
+
+    def put(self, key, roi, region, geometry):
+        """Store the region of interest, mask region and sweep geometry for a cache key."""
+        # Write to a temporary file and rename, so that concurrent processes never read part of a file
+        temp = self.path(key) + '.{}.tmp'.format(os.getpid())
+        with open(temp, 'wb') as f:
+            np.savez(f, roi=np.asarray(roi), region=region, rads=geometry.rads, index=geometry.index)
+        os.replace(temp, self.path(key))
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries if the cache holds more than max_entries."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+        for mtime, path in sorted(entries)[:max(len(entries) - self.max_entries, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                # Entry already removed by another process
+                pass
+
+
+class Profiler(object):
+    """Record the wall time, CPU time and peak memory allocation of analysis stages. Memory is
+    traced with tracemalloc, which slows analysis down, so profiling is opt-in.
+
+    Args:
+        image (str): Name of the image analysed, recorded with each stage.
+        enabled (bool): Record stages. If False, Profiler.stage() does nothing.
+        memory (bool): Trace memory allocation. If False, only times are recorded (peak_kb is None).
+
+    Attributes:
+        records (list): A dict for each stage recorded, with keys Profiler.FIELDS.
+    """
+
+    FIELDS = ['image', 'stage', 'wall_s', 'cpu_s', 'peak_kb']
+
+    def __init__(self, image='', enabled=True, memory=True):
+        self.image = image
+        self.enabled = enabled
+        self.memory = memory
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager recording the code run within it as the stage name."""
+        if not self.enabled:
+            yield
+            return
+        if not self.memory:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                yield
+            finally:
+                self.records.append({'image': self.image, 'stage': name,
+                                     'wall_s': time.perf_counter() - wall,
+                                     'cpu_s': time.process_time() - cpu, 'peak_kb': None})
+            return
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        # Measure the peak allocation above the memory already traced at the start of the stage
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        else:
+            tracemalloc.clear_traces()
+            base = 0
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.records.append({'image': self.image, 'stage': name,
+                                 'wall_s': time.perf_counter() - wall,
+                                 'cpu_s': time.process_time() - cpu,
+                                 'peak_kb': (peak - base) / 1024})
+            if not tracing:
+                tracemalloc.stop()
+
+    @classmethod
+    def write(cls, records, path):
+        """Write a list of stage records to a JSON file, if the path ends with .json, or a CSV file."""
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(records, f, indent=2)
+            else:
+                writer = csv.DictWriter(f, fieldnames=cls.FIELDS)
+                writer.writeheader()
+                writer.writerows(records)
+
+
+class Renderer(object):
+    """Render report plots and images once the numeric results have been written. Figures are queued
+    by plot() and image() and drawn by flush() on a single reused matplotlib figure, which does not
+    share pyplot state with the analysis. With background=True, queued figures are drawn by a worker
+    thread while analysis continues, and flush() waits for the queue to be drawn. At most QUEUE_SIZE
+    figures are held: when the queue is full, queueing a figure waits for the background thread, or
+    draws the oldest figure first, so that a large batch does not hold every image in memory.
+
+    Args:
+        enabled (bool): Set False to discard queued figures, for numeric outputs only.
+        background (bool): Draw figures in a background thread.
+    """
+
+    # Maximum number of figures waiting to be drawn
+    QUEUE_SIZE = 8
+
+    def __init__(self, enabled=True, background=False):
+        self.enabled = enabled
+        self.background = background
+        self.queue = queue.Queue(self.QUEUE_SIZE)
+        self.failures = []
+        self.figure = None
+        self.axes = None
+        self.thread = None
+
+    def plot(self, path, *args, **kwargs):
+        """Queue a line plot, drawn as by matplotlib plot(*args, **kwargs), to be saved to path."""
+        self.put(('plot', path, args, kwargs))
+
+    def image(self, path, image):
+        """Queue an image array to be saved to path."""
+        self.put(('image', path, image, None))
+
+    def put(self, job):
+        if not self.enabled:
+            return
+        if self.background and self.thread is None:
+            self.thread = threading.Thread(target=self.worker, daemon=True)
+            self.thread.start()
+        elif not self.background and self.queue.full():
+            self.render(self.queue.get())
+        self.queue.put(job)
+
+    def render(self, job):
+        """Draw and save a queued figure, recording the path and error if it fails."""
+        kind, path, data, kwargs = job
+        try:
+            if kind == 'image':
+                cv2.imwrite(path, data)
+                return
+            # Create the figure on first use, then clear and reuse it for each plot
+            if self.figure is None:
+                self.figure = Figure()
+                FigureCanvasAgg(self.figure)
+                self.axes = self.figure.add_subplot(111)
+            self.axes.clear()
+            self.axes.plot(*data, **kwargs)
+            self.figure.savefig(path)
+        except Exception as error:
+            self.failures.append((path, error))
+
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            self.render(job)
+            self.queue.task_done()
+
+    def flush(self):
+        """Draw all queued figures, or wait for the background thread to draw them. Returns a list of
+        (path, error) tuples for figures that failed since the last flush."""
+        if self.background:
+            self.queue.join()
+        else:
+            while not self.queue.empty():
+                self.render(self.queue.get())
+        failures, self.failures = self.failures, []
+        return failures
+
+
+def grayscale(image):
+    """Return a single channel (grayscale) image, converting 3 channel images."""
+    if image.ndim == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+def read_frames(infile):
+    """Yield the frames of a DICOM file as pixel arrays, one at a time. Frames are read from the file
+    as they are requested, so the pixel data for all frames is never held in memory. Uncompressed
+    frames are read directly, with YBR_FULL and YBR_FULL_422 frames returned as their luminance (Y)
+    channel. Compressed (encapsulated) frames are decoded with OpenCV, assuming one fragment per frame.
+    """
+    with open(infile, 'rb') as fp:
+        # Read the DICOM header. This leaves the file positioned at the pixel data element.
+        ds = pydicom.dcmread(fp, stop_before_pixels=True)
+        syntax = ds.file_meta.TransferSyntaxUID
+        endian = '>' if syntax == pydicom.uid.ExplicitVRBigEndian else '<'
+        if struct.unpack(endian + 'HH', fp.read(4)) != (0x7FE0, 0x0010):
+            raise IOError('No pixel data found in DICOM file.')
+        # Explicit VR (OB/OW) elements have a 2 byte VR and 2 reserved bytes before the length
+        if syntax != pydicom.uid.ImplicitVRLittleEndian:
+            fp.read(4)
+        length, = struct.unpack(endian + 'L', fp.read(4))
+
+        if length == 0xFFFFFFFF:
+            # Encapsulated pixel data is a sequence of items. The first item is the basic offset
+            # table, followed by the compressed frame fragments.
+            nitem = 0
+            while True:
+                group, element, item_length = struct.unpack('<HHL', fp.read(8))
+                # Stop at the sequence delimiter
+                if (group, element) != (0xFFFE, 0xE000):
+                    break
+                fragment = fp.read(item_length)
+                nitem += 1
+                if nitem == 1:
+                    continue
+                frame = cv2.imdecode(np.frombuffer(fragment, np.uint8), cv2.IMREAD_UNCHANGED)
+                if frame is None:
+                    raise IOError('Unable to decode compressed DICOM frame.')
+                yield frame
+        else:
+            dtype = np.dtype(endian + ('u1' if ds.BitsAllocated == 8 else 'u2'))
+            samples = int(ds.get('SamplesPerPixel', 1))
+            photometric = ds.get('PhotometricInterpretation')
+            planar = samples > 1 and ds.get('PlanarConfiguration', 0) == 1
+            if photometric == 'YBR_FULL_422':
+                # Each pair of pixels is stored as Y1 Y2 Cb Cr, so there are 2 samples per pixel
+                shape = (ds.Rows, ds.Columns // 2, 4)
+            elif planar:
+                shape = (samples, ds.Rows, ds.Columns)
+            elif samples > 1:
+                shape = (ds.Rows, ds.Columns, samples)
+            else:
+                shape = (ds.Rows, ds.Columns)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            for i in range(int(ds.get('NumberOfFrames', 1))):
+                frame = np.frombuffer(fp.read(nbytes), dtype).reshape(shape)
+                if planar:
+                    frame = frame.transpose(1, 2, 0)
+                # The luminance (Y) of YBR frames is the grayscale image
+                if photometric == 'YBR_FULL_422':
+                    frame = frame[:, :, :2].reshape(ds.Rows, ds.Columns)
+                elif photometric == 'YBR_FULL':
+                    frame = np.ascontiguousarray(frame[:, :, 0])
+                yield frame
+
+
+# Photometric interpretations of DICOM pixel data that can be converted to grayscale for analysis
+PHOTOMETRIC = ('MONOCHROME2', 'RGB', 'YBR_FULL', 'YBR_FULL_422')
+# Image file extensions read with OpenCV
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png')
+# OpenCV flags for decoding JPEG and PNG images directly to grayscale at reduced resolution
+REDUCED_GRAYSCALE = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                     4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+
+def triage(infile):
+    """Check whether an input file is a usable reverb capture without decoding pixel data. Only the
+    header of DICOM files is read.
+    Returns:
+        A dict with keys file, modality, rows, columns, photometric, frames, usable (bool) and
+        reason (why the file is not usable, or an empty string). Header values are None for JPEG and
+        PNG files.
+    """
+    info = {'file': infile, 'modality': None, 'rows': None, 'columns': None, 'photometric': None,
+            'frames': None, 'usable': False, 'reason': ''}
+    if not os.path.isfile(infile):
+        info['reason'] = 'Invalid input file.'
+    elif infile.lower().endswith(IMAGE_EXTS):
+        info['usable'] = True
+    elif not infile.endswith('.dcm'):
+        info['reason'] = 'Unsupported file type.'
+    else:
+        try:
+            ds = pydicom.dcmread(infile, stop_before_pixels=True)
+        except pydicom.errors.InvalidDicomError:
+            info['reason'] = 'Not a DICOM file.'
+            return info
+        info.update({'modality': ds.get('Modality'), 'rows': ds.get('Rows'), 'columns': ds.get('Columns'),
+                     'photometric': ds.get('PhotometricInterpretation'),
+                     'frames': int(ds.get('NumberOfFrames', 1))})
+        if info['modality'] not in (None, 'US'):
+            info['reason'] = 'Modality is not ultrasound (US).'
+        elif not (info['rows'] and info['columns']):
+            info['reason'] = 'No image dimensions.'
+        elif info['photometric'] not in PHOTOMETRIC:
+            info['reason'] = 'Unsupported photometric interpretation.'
+        elif ds.get('BitsAllocated') != 8:
+            info['reason'] = 'Pixel data is not 8-bit.'
+        else:
+            info['usable'] = True
+    return info
+
+
+def read_image(infile, direct=False, reduce=1):
+    """Return a grayscale pixel array from an input image file, including DICOM format. Only the
+    first frame of multi-frame DICOM files is decoded.
+    Args:
+        infile (str): Input file in DICOM, JPEG or PNG format.
+        direct (bool): Decode JPEG and PNG images directly to a single channel. This is faster, but
+            pixel values differ slightly from converting the decoded colour image.
+        reduce (int): Downsampling factor (1, 2, 4 or 8) for reduced resolution preview runs. JPEG and
+            PNG images are decoded directly at reduced resolution.
+    """
+    if reduce not in REDUCED_GRAYSCALE:
+        raise ValueError('Reduce factor must be one of 1, 2, 4 or 8.')
+    # Raise error file input file does not exist
+    if not os.path.isfile(infile):
+        raise IOError('Invalid input file.')
+
+    if infile.endswith('.dcm'):
+        # Decode only the first frame of multi-frame (cine) files. YBR files are also read with
+        # read_frames, so single and multi-frame files give the same grayscale image.
+        ds = pydicom.dcmread(infile, stop_before_pixels=True)
+        if int(ds.get('NumberOfFrames', 1)) > 1 or str(ds.get('PhotometricInterpretation')).startswith('YBR'):
+            image = next(read_frames(infile))
+        else:
+            image = pydicom.dcmread(infile).pixel_array
+        return reduce_frame(grayscale(image), reduce)
+
+    if direct or reduce > 1:
+        image = cv2.imread(infile, REDUCED_GRAYSCALE[reduce])
+    else:
+        image = cv2.imread(infile)
+    if image is None:
+        raise IOError('Unable to decode image file.')
+    return grayscale(image)
+
+
+def reduce_frame(image, reduce=1):
+    """Return an image downsampled by taking every reduce-th pixel of every reduce-th row."""
+    if reduce == 1:
+        return image
+    return np.ascontiguousarray(image[::reduce, ::reduce])
+
+
+# Output formats for reverb data. Plots are written for all formats.
+FORMATS = ('csv', 'npz', 'parquet')
+
+
+def write_parquet(path, columns):
+    """Write a dict of columns to a Parquet file. Column values are 1D arrays, 2D arrays (written as
+    a list column, one list per row) or (values, offsets) tuples for ragged list columns where row i
+    holds values[offsets[i]:offsets[i+1]]. Requires pyarrow.
+    """
+    if pyarrow is None:
+        raise ImportError('Parquet output requires pyarrow. Install pyarrow or use --format npz.')
+    arrays = {}
+    for name, column in columns.items():
+        if isinstance(column, tuple):
+            values, offsets = column
+        elif np.ndim(column) == 2:
+            values, offsets = np.ravel(column), np.arange(len(column) + 1) * np.shape(column)[1]
+        else:
+            arrays[name] = pyarrow.array(np.asarray(column))
+            continue
+        arrays[name] = pyarrow.ListArray.from_arrays(pyarrow.array(np.asarray(offsets, dtype=np.int32)),
+                                                     pyarrow.array(np.asarray(values)))
+    pyarrow.parquet.write_table(pyarrow.table(arrays), path)
+
+
+def read_results(path):
+    """Read reverb data written by USimg.write() in npz or parquet format. Pass the .npz file, or the
+    _urqc_data.parquet file (the matching _urqc_depth.parquet file is read from the same directory).
+    Returns:
+        A dict of arrays with keys rads, avgs, values and counts (see SweepData), and the depth
+        matrix (depth) and depth profile (depth_avg) (see SweepData.depth_data()).
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as npz:
+            return {key: npz[key] for key in npz.files}
+    if pyarrow is None:
+        raise ImportError('Reading Parquet output requires pyarrow.')
+    data = pyarrow.parquet.read_table(path).combine_chunks()
+    depth = pyarrow.parquet.read_table(path.replace('_urqc_data.parquet', '_urqc_depth.parquet')).combine_chunks()
+    values = data.column('values').chunk(0)
+    depth_values = depth.column('values').chunk(0)
+    return {'rads': data.column('rads').to_numpy(), 'avgs': data.column('avg').to_numpy(),
+            'values': values.flatten().to_numpy(), 'counts': values.value_lengths().to_numpy().astype(np.int64),
+            'depth': depth_values.flatten().to_numpy().reshape(len(depth), -1),
+            'depth_avg': depth.column('avg').to_numpy()}
+
+
+def header_ids(infile, probe=None):
+    """Return a dict of identifiers for recording a reverb image in a TrendStore. The probe is
+    identified by the DICOM DeviceSerialNumber and first TransducerData value, and the date (ISO
+    format, with the time if available) by the ContentDate, AcquisitionDate or StudyDate. JPEG and PNG
+    files are dated by their modification time. A probe name given as an argument takes precedence.
+    """
+    ids = {'probe': probe, 'date': None}
+    if infile.endswith('.dcm'):
+        ds = pydicom.dcmread(infile, stop_before_pixels=True)
+        transducer = ds.get('TransducerData')
+        if isinstance(transducer, pydicom.multival.MultiValue):
+            transducer = transducer[0] if transducer else None
+        parts = [str(value) for value in (ds.get('DeviceSerialNumber'), transducer) if value]
+        ids['probe'] = probe or ':'.join(parts) or None
+        for date, tm in (('ContentDate', 'ContentTime'), ('AcquisitionDate', 'AcquisitionTime'),
+                         ('StudyDate', 'StudyTime')):
+            value = str(ds.get(date) or '')
+            if len(value) == 8:
+                ids['date'] = '{}-{}-{}'.format(value[:4], value[4:6], value[6:])
+                tm = str(ds.get(tm) or '')
+                if len(tm) >= 6:
+                    ids['date'] += ' {}:{}:{}'.format(tm[:2], tm[2:4], tm[4:6])
+                break
+    if ids['date'] is None:
+        ids['date'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(infile)))
+    ids['probe'] = ids['probe'] or 'unknown'
+    return ids
+
+
+class TrendStore(object):
+    """SQLite store of reverb results for tracking probe performance over time. Each run records the
+    per-step average pixel values and depth profile of one image with its probe and date, indexed by
+    probe and date so that a probe's history can be queried without reading output files.
+
+    Element dropout is flagged where the average pixel value of at least MIN_STEPS consecutive sweep
+    steps falls below (1 - tolerance) times the probe baseline, the earliest run recorded for it.
+
+    Args:
+        path (str): SQLite database file. Created if it does not exist.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            probe TEXT NOT NULL,
+            date TEXT NOT NULL,
+            input TEXT,
+            steps INTEGER,
+            mean REAL,
+            depth_rows INTEGER,
+            depth_mean REAL,
+            avgs BLOB,
+            depth_avg BLOB
+        );
+        CREATE INDEX IF NOT EXISTS runs_probe_date ON runs (probe, date);
+    """
+    TOLERANCE = 0.3
+    MIN_STEPS = 3
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, ids, infile, avgs, depth_avg):
+        """Record the per-step averages and depth profile of a reverb image. ids is a dict with probe
+        and date keys (see header_ids()). Returns the run id."""
+        avgs = np.asarray(avgs, dtype=float)
+        depth_avg = np.asarray(depth_avg, dtype=float)
+        with self.conn:
+            cursor = self.conn.execute(
+                'INSERT INTO runs (probe, date, input, steps, mean, depth_rows, depth_mean, avgs, depth_avg) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (ids['probe'], ids['date'], infile, len(avgs), self.nanmean(avgs), len(depth_avg),
+                 self.nanmean(depth_avg), avgs.tobytes(), depth_avg.tobytes()))
+        return cursor.lastrowid
+
+    def add_summaries(self, summaries):
+        """Record the results of successfully analysed images, from process() summaries made with
+        record=True."""
+        for s in summaries:
+            if s['status'] == 'OK':
+                self.add(s['ids'], s['input'], s['avgs'], s['depth_avg'])
+
+    @staticmethod
+    def nanmean(values):
+        """Return the mean of non-nan values, or None if there are none."""
+        values = values[~np.isnan(values)]
+        return float(values.mean()) if len(values) else None
+
+    def probes(self):
+        """Return a list of the probes with recorded runs."""
+        return [row[0] for row in self.conn.execute('SELECT DISTINCT probe FROM runs ORDER BY probe')]
+
+    def runs(self, probe):
+        """Return a list of runs (dicts) recorded for a probe, in date order. The avgs and depth_avg
+        values are numpy arrays."""
+        cursor = self.conn.execute(
+            'SELECT id, probe, date, input, steps, mean, depth_rows, depth_mean, avgs, depth_avg FROM runs '
+            'WHERE probe = ? ORDER BY date, id', (probe,))
+        fields = [column[0] for column in cursor.description]
+        runs = []
+        for row in cursor:
+            run = dict(zip(fields, row))
+            run['avgs'] = np.frombuffer(run['avgs'], dtype=float)
+            run['depth_avg'] = np.frombuffer(run['depth_avg'], dtype=float)
+            runs.append(run)
+        return runs
+
+    @classmethod
+    def dropout(cls, avgs, baseline, tolerance=TOLERANCE):
+        """Return a list of (first, last) sweep step ranges where avgs fall below (1 - tolerance)
+        times the baseline for at least MIN_STEPS steps. Only steps present in both are compared."""
+        steps = min(len(avgs), len(baseline))
+        with np.errstate(invalid='ignore'):
+            low = np.asarray(avgs[:steps]) < (1 - tolerance) * np.asarray(baseline[:steps])
+        # Find the start and end of each run of low steps
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], low.astype(int), [0]))))
+        return [(int(first), int(end) - 1) for first, end in zip(edges[::2], edges[1::2])
+                if end - first >= cls.MIN_STEPS]
+
+    def trend(self, probe, tolerance=TOLERANCE):
+        """Return the runs recorded for a probe (see TrendStore.runs()), in date order, with the
+        dropout step ranges of each run against the baseline (first) run."""
+        runs = self.runs(probe)
+        for run in runs:
+            run['dropout'] = self.dropout(run['avgs'], runs[0]['avgs'], tolerance)
+        return runs
+
+
+def trend_table(runs):
+    """Return a table of the runs recorded for a probe, with dropout as ranges of sweep radians."""
+    rows = ['{:<19} {:<40} {:>6} {:>8} {:>8} {}'.format('DATE', 'INPUT', 'STEPS', 'MEAN', 'DEPTH', 'DROPOUT')]
+    for run in runs:
+        dropout = ', '.join('{:.3f}-{:.3f}'.format(first * SweepGeometry.RADS, last * SweepGeometry.RADS)
+                            for first, last in run['dropout'])
+        rows.append('{:<19} {:<40} {:>6} {:>8.2f} {:>8.2f} {}'.format(
+            run['date'], os.path.basename(run['input'] or ''), run['steps'],
+            run['mean'] if run['mean'] is not None else float('nan'),
+            run['depth_mean'] if run['depth_mean'] is not None else float('nan'), dropout or '-'))
+    return '\n'.join(rows)
+
+
+class LazyStage(object):
+    """Descriptor for an analysis stage that is computed on first access and cached on the instance.
+    The stage is recorded with the instance profiler. Stages it requires are computed beforehand, so
+    that profiler records do not overlap. Output stages must likewise access the analysis stages they
+    use before they start. Cached values are removed with USimg.invalidate().
+
+    Args:
+        func (function): Method computing the stage value.
+        name (str): Stage name used for profiler records.
+        requires (list): Names of the LazyStage attributes the stage depends on.
+    """
+
+    def __init__(self, func, name, requires=()):
+        self.func = func
+        self.attr = func.__name__
+        self.name = name
+        self.requires = list(requires)
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        for attr in self.requires:
+            getattr(obj, attr)
+        with obj.profiler.stage(self.name):
+            value = self.func(obj)
+        # Store the value on the instance, which takes precedence over this descriptor
+        obj.__dict__[self.attr] = value
+        return value
+
+
+def lazy_stage(name, requires=()):
+    """Decorator returning a LazyStage for a method."""
+    return lambda func: LazyStage(func, name, requires)
+
+
 class USimg(object):
     """Class object for ultrasound (curved array) reverb image processing.
 
+    Analysis stages are computed on first access of the attributes below and cached. Use
+    USimg.invalidate() to recompute stages.
+
     Args:
-        infile (str): Input file in DICOM or JPEG format.
+        infile (str): Input file in DICOM or JPEG format, or a pixel array. Only the first frame of
+            multi-frame DICOM files is read (see USCine).
+        keep_coords (bool): Store the sweep coordinates in USimg.coords. If False, coordinates are
+            dropped after sampling and USimg.coords is None.
+        cache (GeometryCache): Cache to read and store the mask region and sweep geometry. Coordinates
+            are not cached, so keep_coords must be False.
+        profiler (Profiler): Records the time and memory used by each analysis and output stage.
+        direct (bool): Decode JPEG and PNG input files directly to grayscale. See read_image().
+        reduce (int): Downsampling factor for reduced resolution preview runs. See read_image().
 
     Attributes:
+        img (numpy.ndarray): Grayscale input image.
         thresh (numpy.ndarray): Binary image produced using thresholding.
-        maskimg(np.ndarray) : Image with reverberation pattern isolated by segmentation.
         contour(cv2 contour object) : OpenCV contour object.
+        points(dict) : Contour corner points and edge line intersect (see Contour.points).
+        roi(tuple) : Region of interest (x0, y0, x1, y1) bounding the contour and mask dilation.
+        region(np.ndarray) : Binary mask of the reverberation pattern, cropped to roi.
+        mask(np.ndarray) : Image with reverberation pattern isolated by segmentation, cropped to roi.
+        geometry(SweepGeometry) : Sampling geometry of the reverb sweep.
+        coords(np.ndarray) : Array (float32) of sweep coordinates with shape (steps, points, 2).
+        data(SweepData) : Radians and pixel values read at each sweep step.
+        avgs(list) : Radians and average non-zero pixel value for each sweep step.
     """
 
-    def __init__(self, infile):
-        self.img = cv2.cvtColor(self.read(infile), cv2.COLOR_BGR2GRAY)
-        self.thresh = self.threshold()
+    def __init__(self, infile, keep_coords=True, cache=None, profiler=None, direct=False, reduce=1):
+        # Raise error if the input file does not exist
+        if not isinstance(infile, np.ndarray) and not os.path.isfile(infile):
+            raise IOError('Invalid input file.')
+        if cache and keep_coords:
+            raise ValueError('Sweep coordinates are not cached. Use keep_coords=False with a cache.')
+        self.infile = infile
+        self.keep_coords = keep_coords
+        self.cache = cache
+        self.profiler = profiler if profiler else Profiler(enabled=False)
+        self.direct = direct
+        self.reduce = reduce
+
+    # Stage holding the value of each attribute read from a stage tuple
+    STAGE_OF = {'contour': 'contour_points', 'points': 'contour_points', 'roi': 'sampling',
+                'region': 'sampling', 'geometry': 'sampling', 'coords': 'sweep', 'data': 'sweep', 'avgs': 'sweep'}
+
+    def invalidate(self, *names):
+        """Remove the cached values of the named stages and all stages that depend on them, so that
+        they are recomputed on next access. Removes all cached stages if no names are given.
+        Args:
+            names (str): LazyStage or attribute names, e.g. 'thresh', 'mask', 'avgs'.
+        Raises:
+            ValueError: If a name is not a stage or an attribute read from a stage.
+        """
+        stages = {}
+        for cls in reversed(type(self).__mro__):
+            stages.update((attr, stage) for attr, stage in vars(cls).items() if isinstance(stage, LazyStage))
+        names = {self.STAGE_OF.get(name, name) for name in names} if names else set(stages)
+        unknown = names - set(stages)
+        if unknown:
+            raise ValueError('Unknown analysis stage: {}'.format(', '.join(sorted(unknown))))
+        # Add stages requiring an invalidated stage until no more are found
+        while True:
+            dependents = {attr for attr, stage in stages.items() if names.intersection(stage.requires)}
+            if dependents <= names:
+                break
+            names |= dependents
+        for name in names:
+            self.__dict__.pop(name, None)
+
+    @lazy_stage('read')
+    def img(self):
+        """Grayscale input image."""
+        infile = self.infile
+        if isinstance(infile, np.ndarray):
+            return grayscale(infile)
+        return self.read(infile, self.direct, self.reduce)
+
+    @lazy_stage('threshold', requires=['img'])
+    def thresh(self):
+        """Binary image produced using thresholding. See USimg.threshold()."""
+        return self.threshold()
+
+    @lazy_stage('contour', requires=['thresh'])
+    def contour_points(self):
+        """Tuple of the OpenCV contour object for the reverberation pattern and its points."""
         cont = Contour(self.thresh)
-        self.contour = cont.UScontour
-        self.points = cont.points
-        self.mask = self.maskimg()
-        self.coords, self.data, self.avgs = self.reverb_data()
+        return cont.UScontour, cont.points
 
-    @staticmethod
-    def read(infile):
-        """Return a pixel array from an input image file, including DICOM format"""
-        # Raise error file input file does not exist
-        if not os.path.isfile(infile):
-            raise IOError('Invalid input file.')
+    @property
+    def contour(self):
+        """OpenCV contour object for the reverberation pattern."""
+        return self.contour_points[0]
 
-        if infile.endswith('.dcm'):
-            return pydicom.dcmread(infile).pixel_array
-        else:
-            return cv2.imread(infile)
+    @property
+    def points(self):
+        """Dict of contour corner points and edge line intersect. See Contour.points."""
+        return self.contour_points[1]
+
+    @lazy_stage('geometry', requires=['img', 'contour_points'])
+    def sampling(self):
+        """Tuple of the region of interest, mask region and sweep geometry. These are read from the
+        cache if available."""
+        cache = self.cache
+        key = cache.key(self.img.shape, self.points) if cache else None
+        cached = cache.get(key) if cache else None
+        if cached:
+            return cached
+        roi = self.roi_rect()
+        region = self.mask_region(roi)
+        geometry = SweepGeometry(self.points, roi, region, self.img.shape[1], self.keep_coords)
+        if cache:
+            cache.put(key, roi, region, geometry)
+        return roi, region, geometry
+
+    @property
+    def roi(self):
+        """Region of interest (x0, y0, x1, y1). See USimg.roi_rect()."""
+        return self.sampling[0]
+
+    @property
+    def region(self):
+        """Binary mask of the reverberation pattern, cropped to roi. See USimg.mask_region()."""
+        return self.sampling[1]
+
+    @property
+    def geometry(self):
+        """Sampling geometry of the reverb sweep."""
+        return self.sampling[2]
+
+    @lazy_stage('mask', requires=['img', 'sampling'])
+    def mask(self):
+        """Image with reverberation pattern isolated by segmentation. See USimg.maskimg()."""
+        return self.maskimg()
+
+    @lazy_stage('reverb_data', requires=['mask', 'sampling'])
+    def sweep(self):
+        """Tuple of sweep coordinates, pixel values and averages. See USimg.reverb_data()."""
+        return self.reverb_data()
+
+    @property
+    def coords(self):
+        """Array (float32) of sweep coordinates with shape (steps, points, 2), or None."""
+        return self.sweep[0]
+
+    @property
+    def data(self):
+        """SweepData object of radians and pixel values read at each sweep step."""
+        return self.sweep[1]
+
+    @property
+    def avgs(self):
+        """List of radians and average non-zero pixel value for each sweep step."""
+        return self.sweep[2]
+
+    @staticmethod
+    def read(infile, direct=False, reduce=1):
+        """Return a grayscale pixel array from an input image file, including DICOM format. See
+        read_image()."""
+        return read_image(infile, direct, reduce)
 
     def threshold(self):
         """Return an array containing the binary input image after thresholding using Otsu's binarization."""
@@ -164,149 +1224,554 @@ class USimg(object):
         # Return binary image
         return th
 
-    def maskimg(self):
-        """Returns an array containing the original image masked to display the reverberation
-        pattern selected by USimg.contour()."""
-        # Create an empty numpy array with the same dimensions as the input image
-        image = self.img
-        mask = np.zeros(image.shape, np.uint8)
+    # Kernel size and iterations for the morphological dilation of the reverb pattern mask
+    MASK_KERNEL = 8
+    MASK_ITERATIONS = 2
+
+    def roi_rect(self):
+        """Return the region of interest (x0, y0, x1, y1) containing the contour bounding rectangle,
+        expanded by the mask dilation margin and clipped to the image. Pixels of interest lie in
+        img[y0:y1, x0:x1]."""
+        x, y, w, h = cv2.boundingRect(self.contour)
+        margin = self.MASK_KERNEL * self.MASK_ITERATIONS
+        y_max, x_max = self.img.shape
+        return max(x - margin, 0), max(y - margin, 0), min(x + w + margin, x_max), min(y + h + margin, y_max)
+
+    def mask_region(self, roi):
+        """Returns a binary mask of the reverberation pattern selected by USimg.contour(), cropped to
+        a region of interest (x0, y0, x1, y1) from USimg.roi_rect()."""
+        # Create an empty numpy array with the same dimensions as the region of interest
+        x0, y0, x1, y1 = roi
+        mask = np.zeros((y1 - y0, x1 - x0), np.uint8)
         # Obtain the contour for the reverberation pattern
         cont = self.contour
-        # Apply the contour object points to the blank mask
-        cv2.drawContours(mask, [cont], 0, 255, -1)
+        # Apply the contour object points to the blank mask, offset to region of interest coordinates
+        cv2.drawContours(mask, [cont], 0, 255, -1, offset=(-x0, -y0))
         # Expand the mask image boundary using morphological dilation, to capture rough image edges.
-        kernel = np.ones((8, 8), np.uint8)
-        dilate_mask = cv2.dilate(mask, kernel, iterations=2)
+        kernel = np.ones((self.MASK_KERNEL, self.MASK_KERNEL), np.uint8)
+        return cv2.dilate(mask, kernel, iterations=self.MASK_ITERATIONS)
+
+    def maskimg(self, image=None):
+        """Returns an array containing the original image masked to display the reverberation
+        pattern selected by USimg.contour(), cropped to the region of interest USimg.roi.
+        Args:
+            image (np.ndarray): Grayscale image to mask in place of the original image, such as
+                another frame of a cine loop. Must have the same dimensions as the original image.
+        """
+        if image is None:
+            image = self.img
+        x0, y0, x1, y1 = self.roi
+        image = image[y0:y1, x0:x1]
         # Return the mask image.
-        return cv2.bitwise_and(image, image, mask=dilate_mask)
+        return cv2.bitwise_and(image, image, mask=self.region)
+
+    def full_mask(self):
+        """Return the masked image USimg.mask placed in an array with the full input image dimensions."""
+        x0, y0, x1, y1 = self.roi
+        full = np.zeros(self.img.shape, self.mask.dtype)
+        full[y0:y1, x0:x1] = self.mask
+        return full
 
     def reverb_data(self):
-        """Return a tuple containing two data structures resulting from reading the reverb image:
-        us_coords : A list of radians and coordinates. All coordinates are from the line parallel to
-        the contour left edge, rotated by the radians value about the edge line intersect.
-        us_data : A list of radians and pixel values. All pixel values originate from us_coords.
+        """Return a tuple containing three data structures resulting from reading the reverb image:
+        us_coords : An array (float32) of coordinates with shape (steps, points, 2). All coordinates
+        are from the line parallel to the contour left edge, rotated by the step radians value about
+        the edge line intersect. Only points of the line that pass through the region of interest
+        USimg.roi are used. None if the sweep geometry does not keep coordinates.
+        us_data : A SweepData object of radians and pixel values. All pixel values originate from
+        us_coords within the region of interest.
+        us_avgs : A list of radians and the average of non-zero pixel values.
         """
+        us_data, us_avgs = self.sample(self.mask)
+        us_coords = None if self.geometry.coords is None else self.geometry.coords[:len(us_data)]
+        return us_coords, us_data, us_avgs
 
-        # Set the radians value to rotate by
-        RADS = 0.004
-
-        def rotate(point, angle=(-1 * RADS), origin=self.points['ins']):
-            """Rotate a point counterclockwise by a given angle (radians) around a given origin."""
-            ox, oy = origin
-            px, py = point
-            qx = ox + np.cos(angle) * (px - ox) - np.sin(angle) * (py - oy)
-            qy = oy + np.sin(angle) * (px - ox) + np.cos(angle) * (py - oy)
-            return qx, qy
-
-        def coord_filter(coords):
-            """Return the pixel value for a coordinate if it falls within the image array.
-            Returns None if outside of array."""
-            y_max, x_max = self.img.shape
-            x, y = coords
-            if all([(y <= y_max), (y >= 0), (x <= x_max), (x >= 0)]):
-                return self.mask[int(y), int(x)]  # Note img[y,x] slicing versus (x,y) coordinate.
-
-        def avg(data):
-            """Return the average of a list of pixel values."""
-            array = np.asarray(data[1])
-            return data[0], np.mean(array[np.nonzero(array)])
-
-        def sweep(start_coords):
-            """Take a list of coordinates and apply the rotate() function sequentially.
-            Yield the radians value (from start) and coordinates of the points.
-            """
-            nrads = 0
-            mcords = start_coords
-            while sum(filter(lambda x: x is not None, map(coord_filter, mcords))) > 0:
-                nrads += RADS
-                mcords = list(map(rotate, mcords))
-                yield nrads, mcords
+    def sample(self, mask):
+        """Return a SweepData object and list of averages (see USimg.reverb_data()) read from a
+        masked image (see USimg.maskimg()) with the sweep geometry."""
+        return self.geometry.sample(mask)
 
-        # Get cooefficients of the left edge line equation
-        zip_ledge = list(zip(self.points['left'], self.points['top-left']))
-        gradient, y_int = (np.polyfit(zip_ledge[0], zip_ledge[1], 1))
-        # Get list of left edge coordinates (x, int(y))
-        ledge_coords = [(x, (gradient * x + y_int)) for x in range(self.img.shape[1])]
+    def frame_profiles(self, image):
+        """Return arrays of the sweep step averages and the depth profile (see
+        SweepData.depth_data()) for another grayscale image of the same probe, such as a cine frame,
+        read with the mask region and sweep geometry of this image."""
+        data, avgs = self.sample(self.maskimg(image))
+        return np.array([avg for rads, avg in avgs]), data.depth_data()['avg']
 
-        # Rotate the list of left edge coordinates sequentially by the RADS value across the
-        # reverb image. This moves the "line" of coordinates from the left edge to the right.
-        # Store the radians and each coordinate in the us_coords list.
-        us_coords = [[0, ledge_coords]] + [list(coords) for coords in sweep(ledge_coords)]
+    def depth_data(self):
+        """Create data for depth calculations and plots. Emulates reading linear array horizontally.
+        See SweepData.depth_data().
+        """
+        return self.data.depth_data()
 
-        # Create list of rads and pixel values for the coordinates in us_coords. All coordinates
-        # returning None with coord_filter are dropped from the list.
-        us_data = [(rads, list(filter(None.__ne__, map(coord_filter, coords))))
-                   for rads, coords in us_coords]
+    def write(self, prefix, formats=('csv',), renderer=None):
+        """Write out data and plots. Reverb data is written in each of the given formats (see FORMATS).
+        The npz and parquet formats store typed arrays and can be read back with read_results().
+        Plots are queued on renderer, or drawn after the data is written if no renderer is given."""
+        report = renderer if renderer else Renderer()
+        # Run the analysis stages first, so that they are not recorded within the output stages
+        self.sweep
+        # Create output directory if it does not exist. Directories may be created concurrently by
+        # batch mode worker processes.
+        dirlist = ['data', 'plots'] if report.enabled else ['data']
+        for i in dirlist:
+            os.makedirs(i, exist_ok=True)
 
-        us_avgs = list(map(avg, us_data))
+        # Queue masked image
+        if report.enabled:
+            report.image("plots/" + prefix + "_urqc_img.png", self.full_mask())
+        # Write reverb pixel values
+        if 'csv' in formats:
+            with self.profiler.stage('write_data'):
+                with open("data/" + prefix + "_urqc_data.csv", 'w+') as f:
+                    writer = csv.writer(f)
+                    writer.writerows((rads, values.tolist()) for rads, values in self.data)
 
-        return us_coords, us_data, us_avgs
+        # Queue data plot (averages)
+        rads, avgs = zip(*self.avgs)
+        report.plot("plots/" + prefix + "_urqc_plot.png", rads, avgs)
 
-    def depth_data(self):
-        """Create data for depth calculations and plots. Emulates reading linear array horizontally.
+        # Write average raw data
+        if 'csv' in formats:
+            with self.profiler.stage('write_avgs'):
+                with open("data/" + prefix + "_urqc_avgs.csv", 'w') as f:
+                    writer = csv.writer(f)
+                    writer.writerows(self.avgs)
+
+        with self.profiler.stage('depth_data'):
+            depth_data = self.depth_data()
+
+        # Queue depth plot (averages)
+        report.plot("plots/" + prefix + "_urqc_horiz.png", depth_data['avg'], 'r,-')
+
+        # Write depth plot data
+        if 'csv' in formats:
+            with self.profiler.stage('write_depth'):
+                with open("data/" + prefix + "_urqc_depthdata.csv", 'w') as f:
+                    writer = csv.writer(f)
+                    writer.writerows([[depth_data['depth']], [depth_data['rows']]])
+                    writer.writerows([[[tuple(row) for row in depth_data['data'].tolist()]]])
+
+        # Write pixel values, averages and depth data as typed arrays
+        avgs = np.array([avg for rads, avg in self.avgs], dtype=float)
+        if 'npz' in formats:
+            with self.profiler.stage('write_npz'):
+                np.savez("data/" + prefix + "_urqc.npz", rads=self.data.rads, avgs=avgs, values=self.data.values,
+                         counts=self.data.counts, depth=depth_data['data'], depth_avg=depth_data['avg'])
+        if 'parquet' in formats:
+            with self.profiler.stage('write_parquet'):
+                write_parquet("data/" + prefix + "_urqc_data.parquet",
+                              {'rads': self.data.rads, 'avg': avgs, 'values': (self.data.values, self.data.offsets)})
+                write_parquet("data/" + prefix + "_urqc_depth.parquet",
+                              {'row': np.arange(depth_data['rows']), 'avg': depth_data['avg'],
+                               'values': depth_data['data']})
+
+        # Draw plots now if they are not rendered by the caller
+        if renderer is None:
+            with self.profiler.stage('render'):
+                for path, error in report.flush():
+                    raise error
+
+
+class USLinear(USimg):
+    """Class object for linear array probe reverb image processing.
+
+    The reverberation pattern of a linear array is rectangular, with each image column lying beneath
+    one position along the array. Column (element) and depth profiles are the means of the columns and
+    rows of the pattern bounding rectangle, without the rotation sweep used for curved arrays. Every
+    pixel of the rectangle is read, so that dark columns caused by element dropout are included. The
+    attributes of USimg are available, with x coordinates in place of sweep radians: USLinear.data
+    holds the pixel values of each column and USLinear.avgs the average pixel value of each column.
+    There is no sweep geometry, so USLinear.geometry and USLinear.coords are None and the cache is
+    not used.
+
+    Args:
+        See USimg.
+    """
+
+    # Height of the vertical closing kernel joining reverb lines, as a fraction of the image height
+    CLOSE_FRACTION = 0.05
+
+    @lazy_stage('contour', requires=['thresh'])
+    def contour_points(self):
+        """Tuple of the OpenCV contour object for the reverberation pattern and its points."""
+        cont = LinearContour(self.threshold_closed())
+        return cont.UScontour, cont.points
+
+    def threshold_closed(self):
+        """Return the binary image USimg.thresh after morphological closing with a vertical kernel.
+        This joins the horizontal reverb lines of a linear array, which are separated by dark gaps,
+        into a single rectangular pattern."""
+        height = max(3, int(self.thresh.shape[0] * self.CLOSE_FRACTION))
+        return cv2.morphologyEx(self.thresh, cv2.MORPH_CLOSE, np.ones((height, 1), np.uint8))
+
+    @lazy_stage('geometry', requires=['img', 'contour_points'])
+    def sampling(self):
+        """Tuple of the region of interest, mask region and sweep geometry (None)."""
+        roi = self.roi_rect()
+        return roi, self.mask_region(roi), None
+
+    def roi_rect(self):
+        """Return the region of interest (x0, y0, x1, y1) of the contour bounding rectangle. Edge rows
+        and columns without any non-zero pixels, included by blurring before thresholding, are removed."""
+        x, y, w, h = cv2.boundingRect(self.contour)
+        nonzero = self.img[y:y + h, x:x + w] > 0
+        rows, columns = np.flatnonzero(nonzero.any(axis=1)), np.flatnonzero(nonzero.any(axis=0))
+        if not len(rows):
+            return x, y, x + w, y + h
+        return x + int(columns[0]), y + int(rows[0]), x + int(columns[-1]) + 1, y + int(rows[-1]) + 1
+
+    def mask_region(self, roi):
+        """Returns a binary mask selecting the whole region of interest."""
+        x0, y0, x1, y1 = roi
+        return np.full((y1 - y0, x1 - x0), 255, np.uint8)
+
+    def reverb_data(self):
+        """Return a tuple of None (no sweep coordinates), a SweepData object of column x coordinates
+        and pixel values, and a list of x coordinates and the average pixel value of each column.
+        See USLinear.sample()."""
+        us_data, us_avgs = self.sample(self.mask)
+        return None, us_data, us_avgs
+
+    def sample(self, mask):
+        """Return a SweepData object of x coordinates and the pixel values of each column of a masked
+        image (see USimg.maskimg()), and a list of x coordinates and the average pixel value of each
+        column."""
+        rows, columns = mask.shape
+        x = np.arange(self.roi[0], self.roi[2], dtype=float)
+        data = SweepData(x, mask.T.ravel(), np.full(columns, rows))
+        return data, list(zip(x, mask.mean(axis=0)))
+
+    def depth_data(self, mask=None):
+        """Create data for depth calculations and plots from a masked image (default USLinear.mask).
+        Returns a dict with the depth matrix (data), the masked image with shape (rows, columns),
+        the average pixel value of each row (avg), and the number of columns (depth) and rows (rows)
+        read. See SweepData.depth_data().
         """
-        def strip_list(inlist):
-            """Remove leading and trailing 0 values from a list. This removes the empty pixels read
-            from the masked image."""
-            strip = inlist.copy()
-            for index in (0, -1):
-                while strip and (strip[index] == 0):
-                    strip.pop(index)
-            return strip
-
-        # Get a list of lists of pixel values with leading and trailing 0s filtered.
-        # This list is reversed to account for reading of the line in reverse in self.reverb_data()
-        pix_list = [list(reversed(strip_list(i[1]))) for i in self.data]
-
-        # Transpose the nested lists such that each value is stored with others of the same index
-        transp = list(itertools.zip_longest(*pix_list, fillvalue=0))
+        if mask is None:
+            mask = self.mask
+        return {'data': mask, 'avg': mask.mean(axis=1), 'depth': mask.shape[1], 'rows': mask.shape[0]}
 
-        # Get the average for each value.
-        depth_avg = [ np.mean(i) for i in transp ]
+    def frame_profiles(self, image):
+        """Return arrays of the column averages and depth profile for another grayscale image of the
+        same probe, such as a cine frame. See USimg.frame_profiles()."""
+        mask = self.maskimg(image)
+        data, avgs = self.sample(mask)
+        return np.array([avg for x, avg in avgs]), self.depth_data(mask)['avg']
 
-        # Get the maximum depth and rows read
-        us_depth = list(set([len(i) for i in transp]))[0]
-        rows = len(depth_avg)
 
-        return {'data': transp, 'avg': depth_avg, 'depth': us_depth, 'rows': rows}
+class USCine(object):
+    """Class object for reverb processing of every frame in a multi-frame (cine) DICOM file.
+    Frames are decoded and analysed one at a time. The contour and sampling geometry found in the
+    first frame are reused for all frames, as the probe does not move during the cine loop.
+
+    Args:
+        infile (str): Input file in DICOM format.
+        cache (GeometryCache): Cache for the first frame mask region and sweep geometry.
+        profiler (Profiler): Records the time and memory used by each analysis and output stage.
+        reduce (int): Downsampling factor for reduced resolution preview runs. See read_image().
+        linear (bool): Analyse frames from a linear array probe (see USLinear).
+
+    Attributes:
+        first (USimg): Reverb image analysis of the first frame.
+        frames (int): Number of frames analysed.
+        frame_avgs (list): Arrays of the average non-zero pixel value of each sweep step, per frame.
+        frame_depths (list): Arrays of the depth profile (see SweepData.depth_data()), per frame.
+        avgs (list): Radians and frame-averaged average pixel value for each sweep step.
+        depth_avg (np.ndarray): Frame-averaged depth profile.
+    """
+
+    def __init__(self, infile, cache=None, profiler=None, reduce=1, linear=False):
+        self.profiler = profiler if profiler else Profiler(enabled=False)
+        frames = (reduce_frame(grayscale(frame), reduce) for frame in read_frames(infile))
+        probe = USLinear if linear else USimg
+        self.first = probe(next(frames), keep_coords=False, cache=cache, profiler=self.profiler)
+        self.frame_avgs = [np.array([avg for rads, avg in self.first.avgs])]
+        self.frame_depths = [self.first.depth_data()['avg']]
+        # Sample the remaining frames using the first frame mask region and geometry
+        with self.profiler.stage('frames'):
+            for frame in frames:
+                frame_avgs, frame_depth = self.first.frame_profiles(frame)
+                self.frame_avgs.append(frame_avgs)
+                self.frame_depths.append(frame_depth)
+        self.frames = len(self.frame_avgs)
+
+        avgs = self.frame_average(self.frame_avgs)
+        # Radians of every sweep step, or x coordinates of every column for linear arrays
+        rads = self.first.geometry.rads if self.first.geometry else [x for x, avg in self.first.avgs]
+        self.avgs = list(zip(rads[:len(avgs)], avgs))
+        self.depth_avg = self.frame_average(self.frame_depths)
+
+    @staticmethod
+    def pad(profiles):
+        """Return a 2D array (frames, max length) of profiles, with each profile padded by nan."""
+        padded = np.full((len(profiles), max(len(p) for p in profiles)), np.nan)
+        for i, profile in enumerate(profiles):
+            padded[i, :len(profile)] = profile
+        return padded
+
+    @classmethod
+    def frame_average(cls, profiles):
+        """Return the average of each value across frame profiles, ignoring missing (nan) values."""
+        padded = cls.pad(profiles)
+        valid = ~np.isnan(padded)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(valid, padded, 0).sum(axis=0) / valid.sum(axis=0)
 
-    def write(self, prefix):
-        """Write out data and plots."""
+    def write(self, prefix, formats=('csv',), renderer=None):
+        """Write out the first frame masked image, and per-frame and frame-averaged data and plots.
+        Data is written in each of the given formats (see FORMATS). Plots are queued on renderer,
+        or drawn after the data is written if no renderer is given."""
+        report = renderer if renderer else Renderer()
+        # Run the first frame analysis stages first, so that they are not recorded within write_cine
+        self.first.sweep
+        with self.profiler.stage('write_cine'):
+            self._write(prefix, formats, report)
+        if renderer is None:
+            with self.profiler.stage('render'):
+                for path, error in report.flush():
+                    raise error
+
+    def _write(self, prefix, formats, report):
+        """Write out cine outputs. See USCine.write()."""
         # Create output directory if it does not exist
-        dirlist = ['data', 'plots']
+        dirlist = ['data', 'plots'] if report.enabled else ['data']
         for i in dirlist:
-            if not os.path.isdir(i):
-                os.mkdir(i)
+            os.makedirs(i, exist_ok=True)
 
-        # Write masked image
-        cv2.imwrite("plots/" + prefix + "_urqc_img.png", self.mask)
-        # Write reverb pixel values
-        with open("data/" + prefix + "_urqc_data.csv", 'w+') as f:
-            writer = csv.writer(f)
-            writer.writerows(self.data)
+        # Queue masked image of the first frame
+        if report.enabled:
+            report.image("plots/" + prefix + "_urqc_img.png", self.first.full_mask())
+        header = ['mean'] + ['frame_{}'.format(i + 1) for i in range(self.frames)]
 
-        # Write data plot (averages)
+        # Queue data plot (frame-averaged averages)
         rads, avgs = zip(*self.avgs)
-        plt.plot(rads, avgs)
-        plt.savefig(("plots/" + prefix + "_urqc_plot.png"))
-        plt.gcf().clear()
+        report.plot("plots/" + prefix + "_urqc_cine_plot.png", rads, avgs)
 
-        # Write average raw data
-        with open("data/" + prefix + "_urqc_avgs.csv", 'w') as f:
-            writer = csv.writer(f)
-            writer.writerows(self.avgs)
+        # Write frame-averaged and per-frame averages, one row per sweep step
+        frame_avgs = self.pad(self.frame_avgs)
+        if 'csv' in formats:
+            with open("data/" + prefix + "_urqc_cine_avgs.csv", 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(['rads'] + header)
+                writer.writerows(np.column_stack((rads, avgs, frame_avgs.T)).tolist())
 
-        # Write depth plot (averages)
-        depth_data = self.depth_data()
-        plt.plot(depth_data['avg'], 'r,-')
-        plt.savefig(("plots/" + prefix + "_urqc_horiz.png"))
-        plt.gcf().clear()
+        # Queue depth plot (frame-averaged averages)
+        report.plot("plots/" + prefix + "_urqc_cine_horiz.png", self.depth_avg, 'r,-')
 
-        # Write depth plot data
-        with open("data/" + prefix + "_urqc_depthdata.csv", 'w') as f:
-            writer = csv.writer(f)
-            writer.writerows([[depth_data['depth']], [depth_data['rows']]])
-            writer.writerows([[depth_data['data']]])
+        # Write frame-averaged and per-frame depth profiles, one row per depth
+        frame_depths = self.pad(self.frame_depths)
+        if 'csv' in formats:
+            with open("data/" + prefix + "_urqc_cine_depth.csv", 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(['row'] + header)
+                depths = np.column_stack((self.depth_avg, frame_depths.T)).tolist()
+                writer.writerows([row] + values for row, values in enumerate(depths))
+
+        # Write frame-averaged and per-frame profiles as typed arrays, with one frame per row of the
+        # frame_avgs and frame_depths arrays
+        if 'npz' in formats:
+            np.savez("data/" + prefix + "_urqc_cine.npz", rads=np.array(rads), avgs=np.array(avgs),
+                     frame_avgs=frame_avgs, depth_avg=self.depth_avg, frame_depths=frame_depths)
+        if 'parquet' in formats:
+            write_parquet("data/" + prefix + "_urqc_cine_avgs.parquet",
+                          dict(zip(['rads'] + header, [np.array(rads), np.array(avgs)] + list(frame_avgs))))
+            write_parquet("data/" + prefix + "_urqc_cine_depth.parquet",
+                          dict(zip(['row'] + header, [np.arange(len(self.depth_avg)), self.depth_avg] +
+                                   list(frame_depths))))
+
+
+def outprefixes(inputs, outprefix=None, used=()):
+    """Return a list of output file prefixes for a list of input files.
+    Prefixes default to the input filename without extension. If an output prefix is given, it is
+    used for a single input and joined to the input filename for multiple inputs. Inputs that would
+    share a prefix, with each other or with a prefix in used, are numbered in input order (prefix,
+    prefix_2, prefix_3, ...).
+    """
+    prefixes = []
+    for infile in inputs:
+        prefix = os.path.basename(os.path.splitext(infile)[0])
+        if outprefix:
+            prefix = outprefix if len(inputs) == 1 else outprefix + "_" + prefix
+        # Number repeated prefixes so that outputs are not overwritten
+        unique, n = prefix, 1
+        while unique in prefixes or unique in used:
+            n += 1
+            unique = "{}_{}".format(prefix, n)
+        prefixes.append(unique)
+    return prefixes
+
+
+def process(infile, prefix, cine=False, cache_dir=None, profile=False, check=False, direct=False, reduce=1,
+            formats=('csv',), record=False, probe=None, plots=True, renderer=None, linear=False):
+    """Analyse a reverb image and write out data and plots. Returns a dict summarising the result,
+    with the error message as status if the image could not be analysed. If cine is True, every
+    frame of DICOM inputs is analysed using USCine. If cache_dir is given, sampling geometry is read
+    from and stored in a GeometryCache in that directory. If profile is True, the summary 'profile'
+    key holds the Profiler records for each stage. If check is True, files that fail triage() are
+    skipped. See read_image() for direct and reduce. Data is written in each of the given formats.
+    If record is True, the summary also holds the averages (avgs), depth profile (depth_avg) and
+    header identifiers (ids, see header_ids()) for recording in a TrendStore. Plots are queued on
+    renderer if given, else drawn before returning, unless plots is False. If linear is True, images
+    are analysed as linear array probe images (see USLinear)."""
+    summary = {'input': infile, 'prefix': prefix, 'steps': 0, 'mean': float('nan'), 'status': 'OK'}
+    profiler = Profiler(image=infile, enabled=profile)
+    summary['profile'] = profiler.records
+    if check:
+        info = triage(infile)
+        if not info['usable']:
+            summary['status'] = 'SKIPPED: {}'.format(info['reason'])
+            return summary
+    try:
+        cache = GeometryCache(cache_dir) if cache_dir else None
+        # Create an instance of USimg, USLinear or USCine with input
+        if cine and infile.endswith('.dcm'):
+            urqc = USCine(infile, cache=cache, profiler=profiler, reduce=reduce, linear=linear)
+        else:
+            probe_class = USLinear if linear else USimg
+            urqc = probe_class(infile, keep_coords=False, cache=cache, profiler=profiler, direct=direct, reduce=reduce)
+        # Write out data and plots from the reverb image
+        urqc.write(prefix, formats, renderer if renderer or plots else Renderer(enabled=False))
+        if record:
+            summary['ids'] = header_ids(infile, probe)
+            summary['depth_avg'] = urqc.depth_avg if isinstance(urqc, USCine) else urqc.depth_data()['avg']
+    except Exception as error:
+        summary['status'] = 'ERROR: {}'.format(error)
+        return summary
+    avgs = np.array([avg for rads, avg in urqc.avgs], dtype=float)
+    if record:
+        summary['avgs'] = avgs
+    summary['steps'] = len(avgs)
+    summary['mean'] = np.nanmean(avgs) if np.any(~np.isnan(avgs)) else float('nan')
+    return summary
+
+
+class Watcher(object):
+    """Polls an inbox directory for new reverb images. A file is returned once its size and
+    modification time are unchanged between two polls, so that files still being copied in are not
+    read, and only if its content has not been seen before. Content hashes of processed files are
+    appended to a ledger file, so that files are not processed again after a restart or if the same
+    image is exported twice under different names.
+
+    Args:
+        directory (str): Inbox directory to watch.
+        ledger (str): File recording the content hashes of processed files. Defaults to LEDGER in
+            the inbox directory.
+    """
+    EXTS = ('.dcm',) + IMAGE_EXTS
+    LEDGER = '.urqc_seen'
+
+    def __init__(self, directory, ledger=None):
+        if not os.path.isdir(directory):
+            raise IOError('Invalid watch directory.')
+        self.directory = directory
+        self.ledger = ledger if ledger else os.path.join(directory, self.LEDGER)
+        # Size and modification time of files waiting to settle, and of files already hashed
+        self.pending = {}
+        self.checked = {}
+        self.seen = set()
+        if os.path.isfile(self.ledger):
+            with open(self.ledger) as f:
+                self.seen.update(line.strip() for line in f if line.strip())
+
+    @staticmethod
+    def digest(path):
+        """Return the SHA-1 hex digest of a file's content."""
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(functools.partial(f.read, 1 << 20), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def poll(self):
+        """Return a list of (path, digest) tuples for settled files with unseen content, in
+        filename order."""
+        new, digests, present = [], set(), set()
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.lower().endswith(self.EXTS) or not os.path.isfile(path):
+                continue
+            present.add(path)
+            stat = os.stat(path)
+            signature = (stat.st_size, stat.st_mtime)
+            # Skip files already hashed, unless they have been replaced
+            if self.checked.get(path) == signature:
+                continue
+            # Wait until the file is unchanged since the last poll
+            if self.pending.get(path) != signature:
+                self.pending[path] = signature
+                continue
+            del self.pending[path]
+            self.checked[path] = signature
+            digest = self.digest(path)
+            if digest not in self.seen and digest not in digests:
+                digests.add(digest)
+                new.append((path, digest))
+        # Forget files that have been removed from the inbox
+        for files in (self.pending, self.checked):
+            for path in set(files) - present:
+                del files[path]
+        return new
+
+    def done(self, digest):
+        """Record a file's content as processed."""
+        self.seen.add(digest)
+        with open(self.ledger, 'a') as f:
+            f.write(digest + '\n')
+
+
+def watch(watcher, worker, interval=5.0, pool=None, outprefix=None, store=None, renderer=None):
+    """Process new files in a watched inbox until interrupted. Each batch of new files is analysed
+    with worker (see process()), using pool if given, and a summary table is printed. Output prefixes
+    are unique for the life of the watch, so a filename that is used again is numbered rather than
+    overwriting earlier outputs. Files that fail with an error are not recorded as processed, so they
+    are processed again after a restart.
+    Args:
+        watcher (Watcher): Watcher for the inbox directory.
+        worker (callable): Called with the input file and output prefix, returning a summary dict.
+        interval (float): Seconds between polls.
+        pool (concurrent.futures.Executor): Executor for processing files in parallel. The pool is
+            kept for the life of the watch, so that workers are only started once.
+        outprefix (str): Prefix joined to the output file prefix of each input.
+        store (TrendStore): Trend store in which results are recorded.
+        renderer (Renderer): Background renderer used by worker, flushed after each batch.
+    """
+    used = set()
+    while True:
+        new = watcher.poll()
+        if new:
+            paths, digests = zip(*new)
+            prefixes = outprefixes(paths, used=used)
+            used.update(prefixes)
+            if outprefix:
+                prefixes = [outprefix + "_" + prefix for prefix in prefixes]
+            summaries = list((pool.map if pool else map)(worker, paths, prefixes))
+            print(summary_table(summaries), flush=True)
+            render_failures(renderer)
+            if store:
+                store.add_summaries(summaries)
+            for digest, summary in zip(digests, summaries):
+                if not summary['status'].startswith('ERROR'):
+                    watcher.done(digest)
+        time.sleep(interval)
+
+
+def render_failures(renderer):
+    """Wait for a renderer to draw its queued plots, and report plots that could not be drawn.
+    Returns the list of failures (see Renderer.flush())."""
+    failures = renderer.flush() if renderer else []
+    for path, error in failures:
+        sys.stderr.write('ERROR: Unable to write {}: {}\n'.format(path, error))
+    return failures
+
+
+def summary_table(summaries):
+    """Return a table of image summaries, one row per input file."""
+    rows = ['{:<40} {:<30} {:>6} {:>8} {}'.format('INPUT', 'PREFIX', 'STEPS', 'MEAN', 'STATUS')]
+    for s in summaries:
+        rows.append('{:<40} {:<30} {:>6} {:>8.2f} {}'.format(
+            os.path.basename(s['input']), s['prefix'], s['steps'], s['mean'], s['status']))
+    return '\n'.join(rows)
 
 
 if __name__ == "__main__":
@@ -314,19 +1779,109 @@ if __name__ == "__main__":
     # Configure argument parser
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', action='version', version='{} v1.0'.format(parser.prog))
-    parser.add_argument('input', type=str, help='*.jpg, *.png, *.dcm files', metavar='INPUT', nargs='+')
+    parser.add_argument('input', type=str, help='*.jpg, *.png, *.dcm files', metavar='INPUT', nargs='*')
     parser.add_argument('-o', '--outprefix', type=str, help='Output file prefix')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of images to process in parallel (default: 1)')
+    parser.add_argument('--linear', action='store_true',
+                        help='Analyse images from a linear array probe (rectangular reverb pattern)')
+    parser.add_argument('--cine', action='store_true',
+                        help='Analyse every frame of multi-frame (cine) DICOM inputs')
+    parser.add_argument('--cache', type=str, metavar='DIR',
+                        help='Directory for caching sampling geometry between runs')
+    parser.add_argument('--profile', type=str, metavar='FILE',
+                        help='Write the time and peak memory of each stage to FILE (.json or .csv)')
+    parser.add_argument('--triage', action='store_true',
+                        help='Check DICOM headers and skip files that are not usable reverb captures')
+    parser.add_argument('--direct-decode', action='store_true',
+                        help='Decode JPEG and PNG images directly to grayscale (faster, values differ slightly)')
+    parser.add_argument('--preview', type=int, choices=[1, 2, 4, 8], default=1, metavar='N',
+                        help='Analyse images at 1/N resolution for quick previews (N = 2, 4 or 8)')
+    parser.add_argument('--format', action='append', choices=FORMATS, dest='formats',
+                        help='Reverb data output format. Repeat to write several formats (default: csv)')
+    parser.add_argument('--store', type=str, metavar='FILE',
+                        help='Record results in the SQLite trend store FILE')
+    parser.add_argument('--probe', type=str,
+                        help='Probe name to record results under (default: from the DICOM header)')
+    parser.add_argument('--query', type=str, metavar='PROBE',
+                        help='Print the recorded results for PROBE from the trend store and exit')
+    parser.add_argument('--tolerance', type=float, default=TrendStore.TOLERANCE,
+                        help='Fractional drop below baseline flagged as element dropout (default: %(default)s)')
+    parser.add_argument('--watch', type=str, metavar='DIR',
+                        help='Watch DIR for new images and process them as they arrive, until interrupted')
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help='Seconds between polls of the watch directory (default: %(default)s)')
+    parser.add_argument('--ledger', type=str, metavar='FILE',
+                        help='File of content hashes of processed images (default: DIR/{})'.format(Watcher.LEDGER))
+    parser.add_argument('--no-plots', action='store_true',
+                        help='Write numeric outputs only, without plots or the masked image')
     opts, args = parser.parse_known_args()
+    formats = tuple(opts.formats) if opts.formats else ('csv',)
+    if 'parquet' in formats and pyarrow is None:
+        parser.error('--format parquet requires pyarrow')
+    if opts.query and not opts.store:
+        parser.error('--query requires --store')
+    if opts.watch and opts.profile:
+        parser.error('--profile cannot be used with --watch')
+    if not (opts.input or opts.query or opts.watch):
+        parser.error('the following arguments are required: INPUT')
 
-    for input in opts.input:
-        # Create an instance of USimg with input
-        urqc = USimg(input)
-        # Set filename as outprefix for use as default
-        path_no_ext = os.path.splitext(input)[0]
-        outprefix = os.path.basename(path_no_ext)
+    # Print a probe's recorded results with dropout flagged against its baseline
+    if opts.query:
+        store = TrendStore(opts.store)
+        runs, probes = store.trend(opts.query, opts.tolerance), store.probes()
+        store.close()
+        if not runs:
+            sys.exit('No results recorded for probe {}. Recorded probes: {}'.format(
+                opts.query, ', '.join(probes) or 'none'))
+        print(trend_table(runs))
+        sys.exit(0)
 
-        # Write out data and plots from the reverb image
-        if opts.outprefix:
-            urqc.write(opts.outprefix)
-        else:
-            urqc.write(outprefix)
+    # Draw plots in a background thread while later images are analysed. Worker processes, and
+    # profiled runs, draw the plots of each image before moving on to the next.
+    renderer = None
+    if opts.jobs == 1 and not (opts.no_plots or opts.profile):
+        renderer = Renderer(background=True)
+    worker = functools.partial(process, cine=opts.cine, cache_dir=opts.cache, profile=bool(opts.profile),
+                               check=opts.triage, direct=opts.direct_decode, reduce=opts.preview, formats=formats,
+                               record=bool(opts.store), probe=opts.probe, plots=not opts.no_plots,
+                               renderer=renderer, linear=opts.linear)
+
+    # Process new images in the watch directory until interrupted. Worker processes, and the modules
+    # they import, are kept running between polls.
+    if opts.watch:
+        store = TrendStore(opts.store) if opts.store else None
+        with contextlib.ExitStack() as stack:
+            pool = None
+            if opts.jobs > 1:
+                pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=opts.jobs))
+            try:
+                watch(Watcher(opts.watch, opts.ledger), worker, opts.interval, pool, opts.outprefix, store, renderer)
+            except KeyboardInterrupt:
+                pass
+        if store:
+            store.close()
+        sys.exit(0)
+
+    prefixes = outprefixes(opts.input, opts.outprefix)
+
+    if opts.jobs > 1:
+        # Fan images out over a process pool. Results are returned in input order.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=opts.jobs) as pool:
+            summaries = list(pool.map(worker, opts.input, prefixes))
+    else:
+        summaries = list(map(worker, opts.input, prefixes))
+
+    print(summary_table(summaries))
+    failures = render_failures(renderer)
+    # Record results in the trend store, in input order
+    if opts.store:
+        store = TrendStore(opts.store)
+        store.add_summaries(summaries)
+        store.close()
+    # Write stage profiles for all images, in input order
+    if opts.profile:
+        Profiler.write([record for s in summaries for record in s['profile']], opts.profile)
+    # Exit with an error status if any image could not be analysed
+    if failures or any(s['status'].startswith('ERROR') for s in summaries):
+        sys.exit(1)
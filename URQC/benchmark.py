@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+benchmark.py
+Time the UltrasoundReverbQC analysis stages and command line tool on synthetic reverb images (see
+phantom.py) across image sizes. Results are written to a JSON file for comparison between versions.
+
+Usage:
+python3 benchmark.py [-s SIZE [SIZE ...]] [-r REPEATS] [--no-cli] [--compare OLD_JSON] [-o OUTPUT_JSON]
+"""
+from UltrasoundReverbQC import USimg, USLinear, Profiler
+from phantom import curved_phantom, linear_phantom, size
+import argparse
+import cv2
+import json
+import numpy as np
+import os
+import platform
+import pydicom
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'UltrasoundReverbQC.py')
+SIZES = ['640x480', '1024x768', '1920x1080', '3840x2160']
+# Phantom generator, analysis class and command line options for each probe type
+PHANTOMS = {'curved': (curved_phantom, USimg, []), 'linear': (linear_phantom, USLinear, ['--linear'])}
+# Elements dropped out in benchmark phantoms
+DROPOUT = (60, 61, 62)
+
+
+def environment():
+    """Return a dict describing the software and machine the benchmark was run on."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(SCRIPT)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'opencv': cv2.__version__, 'pydicom': pydicom.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+def time_stages(path, phantom, repeats=3):
+    """Return a list of Profiler records (with a repeat number) for each analysis and output stage of
+    a phantom image file, repeated repeats times. Output files are written to a temporary directory."""
+    records = []
+    cwd, workdir = os.getcwd(), tempfile.mkdtemp()
+    try:
+        os.chdir(workdir)
+        for repeat in range(repeats):
+            profiler = Profiler(image=os.path.basename(path), memory=False)
+            img = PHANTOMS[phantom][1](path, keep_coords=False, profiler=profiler)
+            img.write('benchmark', formats=('csv', 'npz'))
+            records.extend(dict(record, repeat=repeat) for record in profiler.records)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    return records
+
+
+def time_cli(path, phantom, repeats=3):
+    """Return a list of records of the wall time taken to run UltrasoundReverbQC.py on a phantom
+    image file, with (stage 'cli') and without (stage 'cli_no_plots') plots. This includes the
+    interpreter start up and module imports."""
+    records = []
+    workdir = tempfile.mkdtemp()
+    try:
+        for repeat in range(repeats):
+            for stage, options in (('cli', []), ('cli_no_plots', ['--no-plots'])):
+                command = [sys.executable, SCRIPT, path] + PHANTOMS[phantom][2] + options
+                wall = time.perf_counter()
+                subprocess.check_call(command, cwd=workdir, stdout=subprocess.DEVNULL)
+                records.append({'image': os.path.basename(path), 'stage': stage, 'repeat': repeat,
+                                'wall_s': time.perf_counter() - wall, 'cpu_s': None, 'peak_kb': None})
+    finally:
+        shutil.rmtree(workdir)
+    return records
+
+
+def summarise(records):
+    """Return a list of dicts with the median and minimum wall time, and median CPU time, of each
+    image and stage over repeats, in the order first recorded."""
+    groups = {}
+    for record in records:
+        groups.setdefault((record['image'], record['stage']), []).append(record)
+    summary = []
+    for (image, stage), group in groups.items():
+        wall = [record['wall_s'] for record in group]
+        cpu = [record['cpu_s'] for record in group if record['cpu_s'] is not None]
+        summary.append({'image': image, 'stage': stage, 'repeats': len(group), 'wall_s': float(np.median(wall)),
+                        'wall_min_s': min(wall), 'cpu_s': float(np.median(cpu)) if cpu else None})
+    return summary
+
+
+def compare(old, new):
+    """Return a table comparing the median wall time of each image and stage in two benchmark
+    result dicts (as written by this script). Ratios above 1 are slower in the new results."""
+    old_times = {(s['image'], s['stage']): s['wall_s'] for s in old['summary']}
+    rows = ['{:<28} {:<14} {:>10} {:>10} {:>7}'.format('IMAGE', 'STAGE', 'OLD_MS', 'NEW_MS', 'RATIO')]
+    for s in new['summary']:
+        before = old_times.get((s['image'], s['stage']))
+        if before is None:
+            continue
+        rows.append('{:<28} {:<14} {:>10.2f} {:>10.2f} {:>7.2f}'.format(
+            s['image'], s['stage'], before * 1000, s['wall_s'] * 1000, s['wall_s'] / before if before else float('nan')))
+    return '\n'.join(rows)
+
+
+def run(sizes, repeats=3, cli=True, phantoms=('curved', 'linear')):
+    """Generate phantom images of each size and probe type, and time them. Returns a dict with the
+    environment, raw records and summary of the results."""
+    records = []
+    imgdir = tempfile.mkdtemp()
+    try:
+        for text in sizes:
+            width, height = size(text)
+            for phantom in phantoms:
+                path = os.path.join(imgdir, '{}_{}x{}.png'.format(phantom, width, height))
+                cv2.imwrite(path, PHANTOMS[phantom][0](width, height, dropout=DROPOUT))
+                records.extend(time_stages(path, phantom, repeats))
+                if cli:
+                    records.extend(time_cli(path, phantom, repeats))
+    finally:
+        shutil.rmtree(imgdir)
+    return {'environment': environment(), 'repeats': repeats, 'summary': summarise(records), 'records': records}
+
+
+if __name__ == "__main__":
+
+    # Configure argument parser
+    parser = argparse.ArgumentParser(description='Benchmark UltrasoundReverbQC on synthetic reverb images')
+    parser.add_argument('-s', '--sizes', nargs='+', default=SIZES, metavar='SIZE',
+                        help='Image sizes WIDTHxHEIGHT (default: {})'.format(' '.join(SIZES)))
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Number of runs per image (default: 3)')
+    parser.add_argument('--phantoms', nargs='+', choices=sorted(PHANTOMS), default=sorted(PHANTOMS),
+                        help='Probe types to benchmark (default: all)')
+    parser.add_argument('--no-cli', action='store_true', help='Do not time the command line tool')
+    parser.add_argument('--compare', type=str, metavar='OLD_JSON', help='Compare with earlier benchmark results')
+    parser.add_argument('-o', '--output', type=str, default='benchmark.json',
+                        help='Output JSON file (default: benchmark.json)')
+    opts = parser.parse_args()
+
+    results = run(opts.sizes, opts.repeats, not opts.no_cli, opts.phantoms)
+    with open(opts.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            print(compare(json.load(f), results))
+    else:
+        for s in results['summary']:
+            print('{:<28} {:<14} {:>10.2f} ms'.format(s['image'], s['stage'], s['wall_s'] * 1000))
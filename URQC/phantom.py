@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+phantom.py
+Generate synthetic in-air reverberation images of curved and linear array ultrasound probes, for
+testing and benchmarking UltrasoundReverbQC.py.
+
+Usage:
+python3 phantom.py [--linear] [-s WIDTHxHEIGHT] [-d DEPTH] [-e ELEMENTS] [--dropout ELEMENT [ELEMENT ...]] output
+"""
+import argparse
+import cv2
+import numpy as np
+
+# Half angle (radians) of the curved array field of view
+HALF_ANGLE = np.radians(40)
+# Pixel value of the vendor headband drawn above the reverb pattern
+HEADBAND = 200
+
+
+def reverb_lines(distance, depth, seed=0):
+    """Return reverb pattern pixel values for an array of distances from the probe face, as
+    horizontal (or concentric) reverb lines fading with depth, with added speckle noise.
+    Args:
+        distance (np.ndarray): Distance (pixels) of each pixel from the probe face.
+        depth (float): Depth (pixels) of the reverb pattern.
+        seed (int): Seed for the speckle noise.
+    """
+    # Space reverb lines so that there are ~12 lines over the pattern depth
+    period = max(depth / 12.0, 4.0)
+    lines = 30 + 190 * np.exp(-distance / (depth / 3.0)) * (0.75 + 0.25 * np.cos(distance / period * 2 * np.pi))
+    noise = np.random.RandomState(seed).normal(0, 8, distance.shape)
+    return np.clip(lines + noise, 1, 255)
+
+
+def dropout_scale(position, elements, dropout, level):
+    """Return the intensity scale for pixels at positions (0 to 1) across the array. Pixels beneath
+    the dropout element indices, of a total of elements, are scaled by level."""
+    scale = np.ones(position.shape)
+    element = np.floor(position * elements).astype(int)
+    scale[np.isin(element, list(dropout))] = level
+    return scale
+
+
+def curved_phantom(width=1024, height=768, depth=0.2, elements=128, dropout=(), level=0.6, seed=0):
+    """Return a grayscale image (uint8) of a curved array reverb pattern: an annular sector of
+    concentric reverb lines about an apex above the image, below a vendor headband.
+    Args:
+        width, height (int): Image size in pixels.
+        depth (float): Radial depth of the reverb pattern as a fraction of the image height.
+        elements (int): Number of array elements across the field of view.
+        dropout (list): Indices of elements that have dropped out.
+        level (float): Intensity scale of dropout elements.
+        seed (int): Seed for the speckle noise.
+    """
+    img = np.zeros((height, width), np.uint8)
+    # Place the apex so that the top of the pattern lies 20% down the image
+    inner = 0.35 * height
+    outer = inner + depth * height
+    apex_x, apex_y = width / 2.0, 0.2 * height - inner
+    yy, xx = np.mgrid[:height, :width]
+    radius = np.hypot(xx - apex_x, yy - apex_y)
+    angle = np.arctan2(xx - apex_x, yy - apex_y)
+    sector = (radius >= inner) & (radius < outer) & (np.abs(angle) < HALF_ANGLE)
+    position = (angle[sector] + HALF_ANGLE) / (2 * HALF_ANGLE)
+    values = reverb_lines(radius[sector] - inner, depth * height, seed)
+    img[sector] = values * dropout_scale(position, elements, dropout, level)
+    img[int(0.01 * height):int(0.04 * height), int(0.05 * width):int(0.95 * width)] = HEADBAND
+    return img
+
+
+def linear_phantom(width=1024, height=768, depth=0.6, elements=128, dropout=(), level=0.6, seed=0):
+    """Return a grayscale image (uint8) of a linear array reverb pattern: a rectangle of horizontal
+    reverb lines, below a vendor headband. See curved_phantom() for arguments. The pattern spans the
+    middle half of the image width."""
+    img = np.zeros((height, width), np.uint8)
+    y0, x0, x1 = int(0.1 * height), width // 4, 3 * width // 4
+    y1 = y0 + int(depth * height)
+    yy, xx = np.mgrid[y0:y1, x0:x1]
+    position = (xx - x0) / float(x1 - x0)
+    values = reverb_lines((yy - y0).astype(float), y1 - y0, seed)
+    img[y0:y1, x0:x1] = values * dropout_scale(position, elements, dropout, level)
+    img[int(0.01 * height):int(0.04 * height), int(0.05 * width):int(0.95 * width)] = HEADBAND
+    return img
+
+
+def size(text):
+    """Parse an image size given as WIDTHxHEIGHT."""
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+
+    # Configure argument parser
+    parser = argparse.ArgumentParser(description='Generate a synthetic reverb image')
+    parser.add_argument('output', type=str, help='Output image file (*.png, *.jpg)')
+    parser.add_argument('--linear', action='store_true', help='Linear array pattern (default: curved array)')
+    parser.add_argument('-s', '--size', type=size, default=(1024, 768), help='Image size WIDTHxHEIGHT')
+    parser.add_argument('-d', '--depth', type=float, help='Pattern depth as a fraction of the image height')
+    parser.add_argument('-e', '--elements', type=int, default=128, help='Number of array elements')
+    parser.add_argument('--dropout', type=int, nargs='+', default=[], metavar='ELEMENT',
+                        help='Indices of elements that have dropped out')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for speckle noise')
+    opts = parser.parse_args()
+
+    phantom = linear_phantom if opts.linear else curved_phantom
+    kwargs = {'depth': opts.depth} if opts.depth else {}
+    width, height = opts.size
+    cv2.imwrite(opts.output, phantom(width, height, elements=opts.elements, dropout=opts.dropout,
+                                     seed=opts.seed, **kwargs))
@@ -1,8 +1,51 @@
 """Unit tests for UltrasoundReverbQC"""
 
-from UltrasoundReverbQC import USimg
+from UltrasoundReverbQC import Contour, USimg, USCine, USLinear, GeometryCache, Profiler, Renderer, SweepGeometry, \
+    TrendStore, Watcher, grayscale, header_ids, outprefixes, read_frames, read_image, read_results, triage, watch
+from phantom import curved_phantom, linear_phantom
+import contextlib
+import cv2
+import io
+import os
+import pydicom
+import shutil
+import tempfile
 import unittest
+import unittest.mock as mock
 import numpy as np
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def reference_sweep(img):
+    """Return a list of radians and non-zero pixel values for each step of the sweep of a USimg,
+    rotating each coordinate of the left edge line one step at a time and reading the full frame
+    masked image point by point. Pixel values are summed as Python integers, so that the stop
+    condition does not overflow."""
+    mask = img.full_mask()
+    y_max, x_max = mask.shape
+    ox, oy = img.points['ins']
+    rads = SweepGeometry.RADS
+
+    def rotate(point):
+        px, py = point
+        return (ox + np.cos(-rads) * (px - ox) - np.sin(-rads) * (py - oy),
+                oy + np.sin(-rads) * (px - ox) + np.cos(-rads) * (py - oy))
+
+    def pixels(coords):
+        return [int(mask[int(y), int(x)]) for x, y in coords if 0 <= x < x_max and 0 <= y < y_max]
+
+    zip_ledge = list(zip(img.points['left'], img.points['top-left']))
+    gradient, y_int = np.polyfit(zip_ledge[0], zip_ledge[1], 1)
+    coords = [(x, gradient * x + y_int) for x in range(x_max)]
+    steps = [(0, pixels(coords))]
+    while sum(steps[-1][1]) > 0:
+        coords = [rotate(point) for point in coords]
+        steps.append((steps[-1][0] + rads, pixels(coords)))
+    return [(nrads, [value for value in values if value]) for nrads, values in steps]
 
 
 class ImageLoadTest(unittest.TestCase):
@@ -22,16 +65,16 @@ class ImageLoadTest(unittest.TestCase):
 
     def test_thresh(self):
         # Test that thresholding produces a binary-value array with only 0 and 255.
-        thresh_j = self.jpg.threshold()
-        thresh_d = self.dcm.threshold()
+        thresh_j = self.jpg.thresh
+        thresh_d = self.dcm.thresh
         unique_array = np.asarray([0, 255])
         self.assertTrue(np.all(unique_array == np.unique(thresh_j)))
         self.assertTrue(np.all(unique_array == np.unique(thresh_d)))
 
     def test_mask(self):
         # Test that the mask is not an empty array
-        mask_j = self.jpg.maskimg()
-        mask_d = self.jpg.maskimg()
+        mask_j = self.jpg.mask
+        mask_d = self.dcm.mask
         self.assertTrue(np.any(mask_j > 0))
         self.assertTrue(np.any(mask_d > 0))
         # Test that the mask contains fewer values than the input file
@@ -39,6 +82,558 @@ class ImageLoadTest(unittest.TestCase):
         self.assertTrue(np.sum(mask_d) < np.sum(self.dcm.img))
         pass
 
+    def test_pyramid(self):
+        # Test that the contour selected on a downsampled 4K threshold image matches the full
+        # resolution contour
+        for img in (self.jpg, self.dcm):
+            h, w = img.thresh.shape
+            large = cv2.resize(img.thresh, (w * 4, h * 4), interpolation=cv2.INTER_NEAREST)
+            self.assertEqual(Contour(large).pyramid_scale(), 4)
+            self.assertTrue(np.array_equal(Contour(large).UScontour, Contour(large, pyramid=False).UScontour))
+
+    def test_lazy(self):
+        # Test that stages are only computed when accessed
+        img = USimg("images/20180220105300406.jpg")
+        self.assertNotIn('img', img.__dict__)
+        img.mask
+        self.assertIn('mask', img.__dict__)
+        self.assertNotIn('sweep', img.__dict__)
+        # Test that invalidating a stage removes it and all stages that depend on it
+        img.avgs
+        img.invalidate('mask')
+        self.assertNotIn('mask', img.__dict__)
+        self.assertNotIn('sweep', img.__dict__)
+        self.assertIn('sampling', img.__dict__)
+        img.invalidate()
+        self.assertNotIn('img', img.__dict__)
+        # Test that invalidating an attribute read from a stage forces the stage to be recomputed
+        avgs = img.avgs
+        img.invalidate('avgs')
+        self.assertNotIn('sweep', img.__dict__)
+        self.assertIn('mask', img.__dict__)
+        self.assertIsNot(img.avgs, avgs)
+        img.invalidate('roi')
+        self.assertNotIn('sampling', img.__dict__)
+        self.assertNotIn('sweep', img.__dict__)
+        self.assertIn('contour_points', img.__dict__)
+        with self.assertRaises(ValueError):
+            img.invalidate('bogus')
+        # Test that stages are recomputed with the same results
+        self.assertTrue(np.array_equal(img.data.values, self.jpg.data.values))
+
+    def test_roi(self):
+        # Test that the region of interest contains the contour and sets the masked image dimensions
+        for img in (self.jpg, self.dcm):
+            x0, y0, x1, y1 = img.roi
+            self.assertTrue(np.all(img.contour[:, :, 0] >= x0) and np.all(img.contour[:, :, 0] < x1))
+            self.assertTrue(np.all(img.contour[:, :, 1] >= y0) and np.all(img.contour[:, :, 1] < y1))
+            self.assertEqual(img.mask.shape, (y1 - y0, x1 - x0))
+            # Test that the full frame mask places the masked image at the region of interest
+            full = img.full_mask()
+            self.assertEqual(full.shape, img.img.shape)
+            self.assertEqual(np.sum(full), np.sum(img.mask))
+
+    def test_reverb_data(self):
+        # Test that the sweep returns one entry per step for coordinates, pixel values and averages
+        for img in (self.jpg, self.dcm):
+            self.assertEqual(len(img.coords), len(img.data))
+            self.assertEqual(len(img.data), len(img.avgs))
+            # Test that the sweep starts at 0 radians and stops at the first step with no pixel values
+            self.assertEqual(img.data[0][0], 0)
+            self.assertFalse(np.any(img.data[-1][1]))
+            self.assertTrue(all(np.any(values) for rads, values in img.data[:-1]))
+
+    def test_reverb_data_reference(self):
+        # Test that the sweep reads the same pixel values and averages as rotating and reading each
+        # coordinate in turn
+        for img in (self.jpg, self.dcm):
+            reference = reference_sweep(img)
+            self.assertEqual(len(img.data), len(reference))
+            for (rads, values), (avg_rads, avg), (ref_rads, ref_values) in zip(img.data, img.avgs, reference):
+                self.assertAlmostEqual(rads, ref_rads)
+                self.assertEqual(values[values != 0].tolist(), ref_values)
+                if ref_values:
+                    self.assertAlmostEqual(avg, np.mean(ref_values))
+                else:
+                    self.assertTrue(np.isnan(avg))
+
+    def test_depth_data(self):
+        # Test that each column of the depth matrix is a sweep step read in reverse, with leading and
+        # trailing 0 values removed and padded with 0s to the depth matrix rows
+        depth = self.jpg.depth_data()
+        self.assertEqual(depth['data'].shape, (depth['rows'], depth['depth']))
+        self.assertEqual(depth['depth'], len(self.jpg.data))
+        for step, (rads, values) in enumerate(self.jpg.data):
+            column = np.trim_zeros(values)[::-1]
+            self.assertTrue(np.array_equal(depth['data'][:len(column), step], column))
+            self.assertFalse(np.any(depth['data'][len(column):, step]))
+        # Test that the depth profile is the average of each row
+        self.assertTrue(np.allclose(depth['avg'], np.mean(depth['data'], axis=1)))
+
+    def test_sweep_storage(self):
+        # Test that sweep coordinates and pixel values are stored as compact arrays
+        self.assertEqual(self.jpg.coords.dtype, np.float32)
+        self.assertEqual(self.jpg.coords.shape[0], len(self.jpg.data))
+        self.assertEqual(self.jpg.coords.shape[2], 2)
+        self.assertEqual(self.jpg.data.values.dtype, np.uint8)
+        self.assertEqual(self.jpg.data.offsets[-1], len(self.jpg.data.values))
+        # Test that coordinates can be dropped without changing the pixel values read
+        dropped = USimg("images/20180220105300406.jpg", keep_coords=False)
+        self.assertIsNone(dropped.coords)
+        self.assertTrue(np.array_equal(dropped.data.values, self.jpg.data.values))
+
+
+class LinearTest(unittest.TestCase):
+    """Tests for linear array probe images."""
+
+    def setUp(self):
+        # Create a rectangular reverb pattern of horizontal lines fading with depth, with dark
+        # columns 400-409 below row 300 (element dropout) and a vendor headband
+        rng = np.random.RandomState(0)
+        rows = np.arange(480)
+        lines = 110 + 90 * np.exp(-rows / 200.0) * (0.6 + 0.4 * np.cos(rows / 40.0 * 2 * np.pi))
+        self.img = np.zeros((600, 800), np.uint8)
+        self.img[80:560, 200:600] = np.clip(lines[:, np.newaxis] + rng.normal(0, 8, (480, 400)), 1, 255)
+        self.img[300:560, 400:410] //= 4
+        self.img[10:30, 50:750] = 200
+        self.linear = USLinear(self.img)
+
+    def test_roi(self):
+        x0, y0, x1, y1 = self.linear.roi
+        self.assertEqual((x0, x1), (200, 600))
+        self.assertLessEqual(abs(y0 - 80) + abs(y1 - 560), 4)
+        self.assertIsNone(self.linear.geometry)
+
+    def test_profiles(self):
+        x0, y0, x1, y1 = self.linear.roi
+        rect = self.img[y0:y1, x0:x1]
+        # Test that column and depth profiles are the exact means of the rectangle
+        x, avgs = zip(*self.linear.avgs)
+        self.assertEqual(x, tuple(range(200, 600)))
+        self.assertTrue(np.allclose(avgs, rect.mean(axis=0)))
+        self.assertTrue(np.allclose(self.linear.depth_data()['avg'], rect.mean(axis=1)))
+        self.assertTrue(np.array_equal(self.linear.data[205][1], rect[:, 205]))
+        # Test that the dropout columns are darker than their neighbours
+        self.assertTrue(max(avgs[200:210]) < 0.8 * min(avgs[190:200] + avgs[210:220]))
+
+
+class CineTest(unittest.TestCase):
+    """Tests for multi-frame (cine) DICOM processing."""
+
+    def setUp(self):
+        # Create a 3 frame cine from the test DICOM image, with a darker second frame
+        ds = pydicom.dcmread("images/IMG_20131212_1_20.dcm")
+        self.frame = ds.pixel_array
+        frames = np.stack([self.frame, self.frame // 2, self.frame])
+        ds.NumberOfFrames = len(frames)
+        ds.PixelData = frames.tobytes()
+        handle, self.cinefile = tempfile.mkstemp(suffix='.dcm')
+        os.close(handle)
+        ds.save_as(self.cinefile)
+
+    def tearDown(self):
+        os.remove(self.cinefile)
+
+    def test_read_frames(self):
+        # Test that frames are read one at a time with the pixel values of each frame
+        frames = list(read_frames(self.cinefile))
+        self.assertEqual(len(frames), 3)
+        self.assertTrue(np.array_equal(frames[0], self.frame))
+        self.assertTrue(np.array_equal(frames[1], self.frame // 2))
+        # Test that single frame DICOM files are read as a single frame
+        self.assertEqual(len(list(read_frames("images/IMG_20131212_1_20.dcm"))), 1)
+
+    def test_read_ybr(self):
+        # Create YBR_FULL and YBR_FULL_422 cines with known luminance and a darker second frame
+        ds = pydicom.dcmread("images/IMG_20131212_1_20.dcm")
+        luma = grayscale(self.frame)
+        frames = [luma, luma // 2, luma]
+        chroma = np.full(luma.shape, 128, np.uint8)
+        full = [np.dstack([y, chroma, chroma]) for y in frames]
+        # YBR_FULL_422 stores each pair of pixels as Y1 Y2 Cb Cr
+        packed = [np.dstack([y[:, 0::2], y[:, 1::2], chroma[:, 0::2], chroma[:, 1::2]]) for y in frames]
+        for photometric, data in (('YBR_FULL', full), ('YBR_FULL_422', packed)):
+            ds.PhotometricInterpretation = photometric
+            ds.NumberOfFrames = len(data)
+            ds.PixelData = np.stack(data).tobytes()
+            ds.save_as(self.cinefile)
+            cine = list(read_frames(self.cinefile))
+            self.assertEqual(len(cine), 3)
+            for frame, y in zip(cine, frames):
+                self.assertTrue(np.array_equal(frame, y))
+            self.assertTrue(np.array_equal(read_image(self.cinefile), luma))
+            # Test that a single frame file gives the same grayscale image as the cine
+            ds.NumberOfFrames = 1
+            ds.PixelData = data[0].tobytes()
+            ds.save_as(self.cinefile)
+            self.assertTrue(np.array_equal(read_image(self.cinefile), luma))
+            self.assertTrue(triage(self.cinefile)['usable'])
+
+    def test_cine(self):
+        cine = USCine(self.cinefile)
+        single = USimg("images/IMG_20131212_1_20.dcm")
+        self.assertEqual(cine.frames, 3)
+        # Test that identical frames give the same profile as the single frame image
+        single_avgs = np.array([avg for rads, avg in single.avgs])
+        self.assertTrue(np.allclose(cine.frame_avgs[0], single_avgs, equal_nan=True))
+        self.assertTrue(np.allclose(cine.frame_avgs[2], single_avgs, equal_nan=True))
+        # Test that the darker frame lowers the frame-averaged profile
+        self.assertLess(np.nanmean(cine.frame_avgs[1]), np.nanmean(cine.frame_avgs[0]))
+        self.assertLess(np.nanmean([avg for rads, avg in cine.avgs]), np.nanmean(single_avgs))
+        self.assertEqual(len(cine.frame_depths), 3)
+
+
+class IngestTest(unittest.TestCase):
+    """Tests for header-only triage and reduced resolution decoding."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_triage(self):
+        self.assertTrue(triage("images/20180220105300406.jpg")['usable'])
+        info = triage("images/IMG_20131212_1_20.dcm")
+        self.assertTrue(info['usable'])
+        self.assertEqual((info['frames'], info['rows']), (1, USimg("images/IMG_20131212_1_20.dcm").img.shape[0]))
+        # Test that files which are not DICOM or images are not usable
+        junk = os.path.join(self.tmpdir, 'junk.dcm')
+        with open(junk, 'w') as f:
+            f.write('junk')
+        self.assertFalse(triage(junk)['usable'])
+        self.assertFalse(triage(os.path.join(self.tmpdir, 'missing.jpg'))['usable'])
+        self.assertFalse(triage("tests.py")['usable'])
+
+    def test_read_image(self):
+        full = read_image("images/20180220105300406.jpg")
+        self.assertEqual(full.ndim, 2)
+        self.assertEqual(read_image("images/20180220105300406.jpg", direct=True).shape, full.shape)
+        reduced = read_image("images/20180220105300406.jpg", reduce=2)
+        self.assertEqual(reduced.shape, ((full.shape[0] + 1) // 2, (full.shape[1] + 1) // 2))
+        dcm = read_image("images/IMG_20131212_1_20.dcm")
+        self.assertTrue(np.array_equal(read_image("images/IMG_20131212_1_20.dcm", reduce=4), dcm[::4, ::4]))
+        self.assertRaises(ValueError, read_image, "images/20180220105300406.jpg", reduce=3)
+        # Test that a reduced image can still be analysed
+        self.assertGreater(len(USimg("images/20180220105300406.jpg", reduce=2).avgs), 0)
+
+
+class OutputFormatTest(unittest.TestCase):
+    """Tests for columnar output formats."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.img = USimg("images/20180220105300406.jpg")
+        # Read the image before changing to the output directory
+        self.img.avgs
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_npz(self):
+        self.img.write('test', formats=('npz',))
+        # Test that legacy CSV data is only written when requested
+        self.assertEqual(sorted(os.listdir('data')), ['test_urqc.npz'])
+        results = read_results('data/test_urqc.npz')
+        self.assertTrue(np.array_equal(results['rads'], self.img.data.rads))
+        self.assertTrue(np.array_equal(results['values'], self.img.data.values))
+        self.assertTrue(np.array_equal(results['counts'], self.img.data.counts))
+        self.assertTrue(np.allclose(results['avgs'], [avg for rads, avg in self.img.avgs], equal_nan=True))
+        self.assertTrue(np.array_equal(results['depth'], self.img.depth_data()['data']))
+        self.assertEqual(results['values'].dtype, np.uint8)
+
+    @unittest.skipUnless(pyarrow, 'Parquet output requires pyarrow')
+    def test_parquet(self):
+        self.img.write('test', formats=('parquet',))
+        self.assertEqual(sorted(os.listdir('data')), ['test_urqc_data.parquet', 'test_urqc_depth.parquet'])
+        # Test that Parquet output is read back with the same values as the npz output
+        self.img.write('test', formats=('npz',))
+        results = read_results('data/test_urqc_data.parquet')
+        expected = read_results('data/test_urqc.npz')
+        for key in ('rads', 'avgs', 'values', 'counts', 'depth', 'depth_avg'):
+            self.assertTrue(np.allclose(results[key], expected[key], equal_nan=True), key)
+        self.assertEqual(results['values'].dtype, np.uint8)
+
+    @unittest.skipUnless(pyarrow, 'Parquet output requires pyarrow')
+    def test_cine_parquet(self):
+        # Create a 2 frame cine from the test DICOM image, with a darker second frame
+        ds = pydicom.dcmread(os.path.join(self.cwd, "images/IMG_20131212_1_20.dcm"))
+        frame = ds.pixel_array
+        ds.NumberOfFrames = 2
+        ds.PixelData = np.stack([frame, frame // 2]).tobytes()
+        ds.save_as('cine.dcm')
+        cine = USCine('cine.dcm')
+        cine.write('cine', formats=('parquet', 'npz'), renderer=Renderer(enabled=False))
+        # Test that the frame-averaged and per-frame profiles match the npz output
+        with np.load('data/cine_urqc_cine.npz') as npz:
+            avgs = pyarrow.parquet.read_table('data/cine_urqc_cine_avgs.parquet')
+            self.assertEqual(avgs.column_names, ['rads', 'mean', 'frame_1', 'frame_2'])
+            self.assertTrue(np.array_equal(avgs.column('rads').to_numpy(), npz['rads']))
+            self.assertTrue(np.allclose(avgs.column('mean').to_numpy(), npz['avgs'], equal_nan=True))
+            depth = pyarrow.parquet.read_table('data/cine_urqc_cine_depth.parquet')
+            self.assertTrue(np.allclose(depth.column('mean').to_numpy(), npz['depth_avg'], equal_nan=True))
+            for i in range(2):
+                name = 'frame_{}'.format(i + 1)
+                self.assertTrue(np.allclose(avgs.column(name).to_numpy(), npz['frame_avgs'][i], equal_nan=True))
+                self.assertTrue(np.allclose(depth.column(name).to_numpy(), npz['frame_depths'][i], equal_nan=True))
+
+    def test_renderer(self):
+        # Test that no plots are written by a disabled renderer
+        self.img.write('test', renderer=Renderer(enabled=False))
+        self.assertFalse(os.path.exists('plots'))
+        self.assertIn('test_urqc_avgs.csv', os.listdir('data'))
+        # Test that queued plots are written when a background renderer is flushed
+        renderer = Renderer(background=True)
+        self.img.write('test', renderer=renderer)
+        self.assertEqual(renderer.flush(), [])
+        self.assertEqual(sorted(os.listdir('plots')),
+                         ['test_urqc_horiz.png', 'test_urqc_img.png', 'test_urqc_plot.png'])
+        # Test that plot failures are returned
+        renderer.plot('missing/test.png', [0, 1])
+        self.assertEqual([path for path, error in renderer.flush()], ['missing/test.png'])
+        # Test that a foreground renderer holds at most QUEUE_SIZE figures, drawing the oldest when full
+        renderer = Renderer()
+        for i in range(Renderer.QUEUE_SIZE + 3):
+            renderer.image('plots/queued_{}.png'.format(i), np.zeros((4, 4), np.uint8))
+            self.assertLessEqual(renderer.queue.qsize(), Renderer.QUEUE_SIZE)
+        self.assertEqual(len([f for f in os.listdir('plots') if f.startswith('queued')]), 3)
+        self.assertEqual(renderer.flush(), [])
+        self.assertEqual(len([f for f in os.listdir('plots') if f.startswith('queued')]), Renderer.QUEUE_SIZE + 3)
+
+
+class TrendStoreTest(unittest.TestCase):
+    """Tests for the trend store."""
+
+    def setUp(self):
+        self.store = TrendStore(':memory:')
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_header_ids(self):
+        ids = header_ids("images/IMG_20131212_1_20.dcm")
+        self.assertEqual(ids['probe'], 'D20819')
+        self.assertTrue(ids['date'].startswith('2013-12-12'))
+        self.assertEqual(header_ids("images/20180220105300406.jpg", probe='C5-1')['probe'], 'C5-1')
+
+    def test_trend(self):
+        img = USimg("images/IMG_20131212_1_20.dcm")
+        avgs = np.array([avg for rads, avg in img.avgs])
+        self.store.add({'probe': 'D20819', 'date': '2013-12-12'}, 'baseline.dcm', avgs, img.depth_data()['avg'])
+        # Record a later run with reduced intensity over 20 steps, in the middle of the sweep
+        dropped = avgs.copy()
+        dropped[100:120] *= 0.5
+        self.store.add({'probe': 'D20819', 'date': '2014-01-12'}, 'later.dcm', dropped, img.depth_data()['avg'])
+        self.store.add({'probe': 'other', 'date': '2014-01-12'}, 'other.dcm', dropped, [])
+        self.assertEqual(self.store.probes(), ['D20819', 'other'])
+        runs = self.store.trend('D20819')
+        self.assertEqual([run['input'] for run in runs], ['baseline.dcm', 'later.dcm'])
+        self.assertTrue(np.array_equal(runs[1]['avgs'], dropped, equal_nan=True))
+        self.assertEqual([run['dropout'] for run in runs], [[], [(100, 119)]])
+
+
+class WatcherTest(unittest.TestCase):
+    """Tests for the watch directory poller."""
+
+    def setUp(self):
+        self.inbox = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.inbox)
+
+    def test_poll(self):
+        watcher = Watcher(self.inbox)
+        first = os.path.join(self.inbox, 'a.jpg')
+        shutil.copy("images/20180220105300406.jpg", first)
+        # Test that files are returned once they are unchanged between polls
+        self.assertEqual(watcher.poll(), [])
+        new = watcher.poll()
+        self.assertEqual([path for path, digest in new], [first])
+        watcher.done(new[0][1])
+        self.assertEqual(watcher.poll(), [])
+        # Test that copies of processed files are skipped, including after a restart
+        shutil.copy("images/20180220105300406.jpg", os.path.join(self.inbox, 'b.jpg'))
+        with open(os.path.join(self.inbox, 'notes.txt'), 'w') as f:
+            f.write('notes')
+        restarted = Watcher(self.inbox)
+        self.assertEqual(restarted.poll() + restarted.poll(), [])
+        shutil.copy("images/IMG_20131212_1_20.dcm", self.inbox)
+        watcher.poll()
+        self.assertEqual([os.path.basename(path) for path, digest in watcher.poll()], ['IMG_20131212_1_20.dcm'])
+        # Test that removed files are forgotten
+        os.remove(first)
+        watcher.poll()
+        self.assertNotIn(first, watcher.checked)
+
+    def test_watch(self):
+        watcher = Watcher(self.inbox)
+        shutil.copy("images/20180220105300406.jpg", os.path.join(self.inbox, 'a.jpg'))
+        shutil.copy("images/IMG_20131212_1_20.dcm", os.path.join(self.inbox, 'bad.dcm'))
+        prefixes = []
+
+        def worker(infile, prefix):
+            prefixes.append(prefix)
+            status = 'ERROR: bad' if infile.endswith('bad.dcm') else 'OK'
+            return {'input': infile, 'prefix': prefix, 'steps': 0, 'mean': float('nan'), 'status': status}
+
+        def sleep(interval):
+            # Replace a.jpg with new content after the first batch, and stop after the second
+            sleep.calls += 1
+            if sleep.calls == 2:
+                with open(os.path.join(self.inbox, 'a.jpg'), 'ab') as f:
+                    f.write(b'new')
+            elif sleep.calls == 4:
+                raise KeyboardInterrupt
+        sleep.calls = 0
+
+        with mock.patch('UltrasoundReverbQC.time.sleep', sleep), contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(KeyboardInterrupt):
+                watch(watcher, worker, interval=0)
+        # Test that a filename used again is numbered rather than overwriting earlier outputs
+        self.assertEqual(prefixes, ['a', 'bad', 'a_2'])
+        # Test that only files processed without error are recorded
+        with open(watcher.ledger) as f:
+            seen = f.read().split()
+        self.assertEqual(len(seen), 2)
+        self.assertNotIn(Watcher.digest(os.path.join(self.inbox, 'bad.dcm')), seen)
+
+
+class GeometryCacheTest(unittest.TestCase):
+    """Tests for the sampling geometry cache."""
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def test_cache(self):
+        cache = GeometryCache(self.cachedir, max_entries=1)
+        first = USimg("images/20180220105300406.jpg", keep_coords=False, cache=cache)
+        first.avgs
+        key = cache.key(first.img.shape, first.points)
+        self.assertIsNotNone(cache.get(key))
+        # Test that a cached geometry gives the same results
+        cached = USimg("images/20180220105300406.jpg", keep_coords=False, cache=cache)
+        self.assertEqual(cached.roi, first.roi)
+        self.assertTrue(np.array_equal(cached.data.values, first.data.values))
+        self.assertTrue(np.allclose([a for r, a in cached.avgs], [a for r, a in first.avgs], equal_nan=True))
+        # Test that the least recently used entry is removed when the cache is full
+        USimg("images/IMG_20131212_1_20.dcm", keep_coords=False, cache=cache).avgs
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+        # Test that a cache cannot be used when coordinates are kept, as coordinates are not cached
+        with self.assertRaises(ValueError):
+            USimg("images/20180220105300406.jpg", cache=cache)
+
+
+class ProfilerTest(unittest.TestCase):
+    """Tests for stage profiling."""
+
+    def test_profiler(self):
+        profiler = Profiler(image='jpg')
+        USimg("images/20180220105300406.jpg", profiler=profiler).avgs
+        # Test that a record is made for each analysis stage, in order
+        stages = [record['stage'] for record in profiler.records]
+        self.assertEqual(stages, ['read', 'threshold', 'contour', 'geometry', 'mask', 'reverb_data'])
+        for record in profiler.records:
+            self.assertEqual(set(record.keys()), set(Profiler.FIELDS))
+            self.assertGreaterEqual(record['wall_s'], 0)
+        # Test that no records are made if the profiler is disabled
+        disabled = Profiler(enabled=False)
+        USimg("images/20180220105300406.jpg", profiler=disabled).avgs
+        self.assertEqual(disabled.records, [])
+        # Test that peak memory is not traced when memory profiling is off
+        times = Profiler(memory=False)
+        USimg("images/20180220105300406.jpg", profiler=times).avgs
+        self.assertTrue(all(record['peak_kb'] is None for record in times.records))
+
+
+class NestingProfiler(Profiler):
+    """Profiler recording the names of stages started within another stage."""
+
+    def __init__(self):
+        super(NestingProfiler, self).__init__(memory=False)
+        self.depth = 0
+        self.nested = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.depth:
+            self.nested.append(name)
+        self.depth += 1
+        try:
+            with Profiler.stage(self, name):
+                yield
+        finally:
+            self.depth -= 1
+
+
+class ProfilerNestingTest(unittest.TestCase):
+    """Tests that output stages do not record analysis stages within them."""
+
+    def setUp(self):
+        self.cwd, self.workdir = os.getcwd(), tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def test_write(self):
+        images = [("images/20180220105300406.jpg", USimg), (linear_phantom(800, 600), USLinear)]
+        infiles = [(os.path.abspath(infile) if isinstance(infile, str) else infile, probe) for infile, probe in images]
+        os.chdir(self.workdir)
+        for infile, probe in infiles:
+            for plots in (True, False):
+                profiler = NestingProfiler()
+                probe(infile, keep_coords=False, profiler=profiler).write('nest', formats=('csv', 'npz'),
+                                                                          renderer=Renderer(enabled=plots))
+                self.assertEqual(profiler.nested, [])
+                self.assertEqual(profiler.records[0]['stage'], 'read')
+
+
+class BatchTest(unittest.TestCase):
+    """Tests for batch mode processing of multiple images."""
+
+    def test_outprefixes(self):
+        # Test that prefixes default to the input filename
+        self.assertEqual(outprefixes(['images/a.jpg', 'b.dcm']), ['a', 'b'])
+        # Test that an output prefix is used as-is for a single input and joined for multiple inputs
+        self.assertEqual(outprefixes(['images/a.jpg'], 'out'), ['out'])
+        self.assertEqual(outprefixes(['images/a.jpg', 'b.dcm'], 'out'), ['out_a', 'out_b'])
+        # Test that repeated prefixes are numbered in input order
+        self.assertEqual(outprefixes(['x/a.jpg', 'y/a.jpg', 'a.dcm']), ['a', 'a_2', 'a_3'])
+        # Test that prefixes already in use are numbered
+        self.assertEqual(outprefixes(['a.jpg', 'b.jpg'], used={'a', 'a_2'}), ['a_3', 'b'])
+
+
+class PhantomTest(unittest.TestCase):
+    """Tests for synthetic reverb images."""
+
+    def test_curved(self):
+        # Test that a curved phantom is contoured across image sizes and that dropout elements add
+        # sweep steps darker than the rest of the pattern
+        def dark_steps(img):
+            avgs = np.array([avg for rads, avg in img.avgs], dtype=float)
+            self.assertGreater(len(avgs), 100)
+            return np.sum(avgs < 0.75 * np.nanmedian(avgs))
+        for width, height in [(640, 480), (1920, 1080)]:
+            normal = dark_steps(USimg(curved_phantom(width, height)))
+            dropout = dark_steps(USimg(curved_phantom(width, height, dropout=[60, 61, 62])))
+            self.assertGreaterEqual(dropout - normal, 3)
+
+    def test_linear(self):
+        # Test that the linear phantom region is the middle half of the image, and that dropout columns
+        # are darker than the rest of the pattern
+        linear = USLinear(linear_phantom(800, 600, dropout=[64]))
+        self.assertIsNone(linear.geometry)
+        x, avgs = zip(*linear.avgs)
+        self.assertEqual(x, tuple(range(200, 600)))
+        self.assertLess(avgs[x.index(401)], 0.8 * np.median(avgs))
+
 
 # TODO: Future tests
 